@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Argument binding time for an 8 arg endpoint.
+
+    python -m benchmarks.binding
+
+    "argspec" calls each arg's argspec like the publisher used to,
+    "binder" is the endpoint's compiled Endpoint.bind.
+"""
+
+import timeit
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+import nudge.arg as args
+from nudge.publisher import Endpoint, WSGIRequest, _InArgs
+
+REPEAT = 20000
+QUERY = 'name=a&count=3&limit=4&flag=true&when=20110101&tag=x&score=1.5'
+
+
+def _endpoint():
+    return Endpoint(
+        name='resource',
+        method='GET',
+        uri='/resource/(?P<id>\d+)$',
+        function=lambda *a, **kw: None,
+        args=([
+            args.Integer('id'),
+            args.String('name'),
+            args.Integer('count', optional=True, default=10),
+            args.Boolean('flag', optional=True),
+            args.Date('when', optional=True),
+            args.String('tag', optional=True),
+            args.Float('score', optional=True),
+        ], {
+            'limit': args.Integer('limit', max_=5, optional=True),
+        }),
+    )
+
+
+def _argspec(endpoint, req, path_args):
+    inargs = _InArgs(req, path_args)
+    positional = [arg.argspec(req, inargs) for arg in endpoint.sequential]
+    kwargs = {}
+    for argname, arg in endpoint.named.iteritems():
+        r = arg.argspec(req, inargs)
+        if r != None:
+            kwargs[argname] = r
+    return positional, kwargs
+
+
+def main():
+    endpoint = _endpoint()
+    req = WSGIRequest({
+        'REQUEST_METHOD': 'GET',
+        'QUERY_STRING': QUERY,
+        'wsgi.input': StringIO.StringIO(''),
+    })
+    path_args = {'id': '1234'}
+    assert _argspec(endpoint, req, path_args) == \
+        endpoint.bind(req, path_args)
+
+    print "%10s %14s" % ('', 'time (us)')
+    for name, bind in [
+            ('argspec', lambda: _argspec(endpoint, req, path_args)),
+            ('binder', lambda: endpoint.bind(req, path_args))]:
+        elapsed = min(timeit.repeat(bind, number=REPEAT, repeat=3))
+        print "%10s %14.2f" % (name, elapsed * 1e6 / REPEAT)
+
+
+if __name__ == '__main__':
+    main()
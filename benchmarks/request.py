@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Per request allocations and time for building a WSGIRequest.
+
+    python -m benchmarks.request
+
+    "wrapped" is how WSGIRequest used to be built, an instance with a
+    __dict__ holding a Dictomatic.wrap copy of the environ. "view" is the
+    current __slots__ request over the environ itself. Allocations are
+    the objects tracked by the garbage collector that building a request
+    allocates, including ones freed before it returns (eg. the copies made
+    wrapping the environ). Bytes are what each request keeps: the request,
+    its __dict__ and its environ wrapper.
+"""
+
+import gc
+import sys
+import timeit
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+from nudge.json import Dictomatic
+from nudge.publisher import WSGIRequest
+
+COUNT = 10000
+# requests measured one at a time for allocations, each drains free lists
+ALLOCATION_COUNT = 200
+
+
+def _environ():
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': '/api/v1/resource/1234',
+        'QUERY_STRING': 'a=1&b=2',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8080',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': 'localhost:8080',
+        'HTTP_ACCEPT': '*/*',
+        'HTTP_USER_AGENT': 'benchmark',
+        'HTTP_COOKIE': 'session=abc; theme=dark',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO.StringIO(''),
+        'wsgi.errors': None,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    return environ
+
+
+class _WrappedRequest(WSGIRequest):
+    # no __slots__, so instances get a __dict__ like they used to
+
+    def __init__(self, req_dict):
+        WSGIRequest.__init__(self, req_dict)
+        self.req = Dictomatic.wrap(req_dict)
+
+
+def _bytes(request):
+    size = sys.getsizeof(request) + sys.getsizeof(request.req)
+    if hasattr(request, '__dict__'):
+        size += sys.getsizeof(request.__dict__)
+    return size
+
+
+def _drain_free_lists():
+    # CPython reuses freed tuples, lists and dicts without counting them as
+    # allocations, holding fresh ones keeps those free lists empty
+    return [tuple(range(n)) for n in xrange(1, 21) for i in xrange(2000)] + \
+        [{} for i in xrange(100)] + [[] for i in xrange(100)]
+
+
+def _allocations(build, environs):
+    # With the collector off gc.get_count()[0] goes up for each allocation
+    # of a tracked object and down when one is freed, unless it was put on
+    # a free list. So with the free lists empty, temporaries are counted
+    # too.
+    requests = []
+    total = 0
+    for environ in environs:
+        gc.collect()
+        held = _drain_free_lists()
+        gc.disable()
+        try:
+            before = gc.get_count()[0]
+            requests.append(build(environ))
+            total += gc.get_count()[0] - before
+        finally:
+            gc.enable()
+        del held
+    return float(total) / len(requests)
+
+
+def main():
+    print "%10s %18s %16s %14s" % (
+        '', 'allocs/request', 'bytes/request', 'time (us)')
+    for name, build in [('wrapped', _WrappedRequest), ('view', WSGIRequest)]:
+        environs = [_environ() for i in xrange(ALLOCATION_COUNT)]
+        allocations = _allocations(build, environs)
+        environ = _environ()
+        elapsed = min(timeit.repeat(
+            lambda: build(environ), number=COUNT, repeat=3))
+        print "%10s %18.2f %16d %14.2f" % (
+            name, allocations, _bytes(build(environ)),
+            elapsed * 1e6 / COUNT)
+
+if __name__ == '__main__':
+    main()
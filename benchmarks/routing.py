@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Dispatch time against the number of registered endpoints.
+
+    python -m benchmarks.routing
+
+    Requests always hit the last registered endpoint, the worst case for
+    the old linear regex scan. The "regex" uris can match across a '/', so
+    the router keeps them as (alternation) regexes instead of tree nodes.
+"""
+
+import timeit
+
+from nudge.publisher import Endpoint
+from nudge.router import Router
+
+SIZES = [10, 100, 1000, 10000]
+REPEAT = 2000
+URIS = [
+    ('tree', '/api/v1/resource%d/(?P<id>\d+)$'),
+    ('regex', '/api/v1/resource%d/(?P<id>.+)$'),
+]
+
+
+def _endpoints(count, uri):
+    handler = lambda id: None
+    return [
+        Endpoint(
+            name='resource%d' % i,
+            method='GET',
+            uri=uri % i,
+            function=handler,
+        ) for i in xrange(count)
+    ]
+
+
+def _linear(endpoints, reqline):
+    for endpoint in endpoints:
+        match = endpoint.match(reqline)
+        if match:
+            return endpoint, match.groupdict()
+
+
+def main():
+    for kind, uri in URIS:
+        print kind
+        _run(uri)
+
+
+def _run(uri):
+    print "%10s %14s %14s" % ('endpoints', 'linear (us)', 'router (us)')
+    for count in SIZES:
+        endpoints = _endpoints(count, uri)
+        router = Router()
+        for endpoint in endpoints:
+            router.add(endpoint)
+        path = '/api/v1/resource%d/1234' % (count - 1)
+        assert router.match('GET', path)[0] is endpoints[-1]
+
+        linear = min(timeit.repeat(
+            lambda: _linear(endpoints, 'GET' + path), number=REPEAT, repeat=3))
+        routed = min(timeit.repeat(
+            lambda: router.match('GET', path), number=REPEAT, repeat=3))
+        print "%10d %14.2f %14.2f" % (
+            count, linear * 1e6 / REPEAT, routed * 1e6 / REPEAT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Validating a decoded order body of 50 line items.
+
+    python -m benchmarks.schema
+
+    "by hand" chains the flat validators the way endpoints used to,
+    "schema" is the same check compiled with validator.Schema.
+"""
+
+import timeit
+
+import nudge.validator as vals
+
+REPEAT = 2000
+BODY = {
+    'customer': {'id': '42', 'email': 'a@example.com'},
+    'note': 'leave at the door',
+    'items': [
+        {'sku': 'sku-%d' % i, 'quantity': i % 5 + 1, 'price': '9.99'}
+        for i in xrange(50)
+    ],
+}
+
+_id = vals.Int(min_=1)
+_email = vals.String()
+_note = vals.String()
+_sku = vals.String()
+_quantity = vals.Int(min_=1, max_=100)
+_price = vals.Float(min_=0)
+_dict = vals.Dict()
+_list = vals.List(min_=1, max_=100)
+
+
+def by_hand(body):
+    def field(d, key, validator, path):
+        if key not in d:
+            raise vals.ValidationError("%s: is required" % path)
+        try:
+            return validator(d[key])
+        except (vals.ValidationError), e:
+            raise vals.ValidationError("%s: %s" % (path, e.message))
+    _dict(body)
+    customer = _dict(field(body, 'customer', _dict, 'customer'))
+    result = dict(body)
+    result['customer'] = dict(customer,
+        id=field(customer, 'id', _id, 'customer.id'),
+        email=field(customer, 'email', _email, 'customer.email'))
+    if 'note' in body:
+        result['note'] = field(body, 'note', _note, 'note')
+    items = []
+    for i, item in enumerate(field(body, 'items', _list, 'items')):
+        path = 'items[%d]' % i
+        _dict(item)
+        items.append(dict(item,
+            sku=field(item, 'sku', _sku, path + '.sku'),
+            quantity=field(item, 'quantity', _quantity, path + '.quantity'),
+            price=field(item, 'price', _price, path + '.price')))
+    result['items'] = items
+    return result
+
+
+schema = vals.Schema({
+    'customer': {'id': _id, 'email': _email},
+    vals.Optional('note'): _note,
+    'items': vals.ListOf(
+        {'sku': _sku, 'quantity': _quantity, 'price': _price},
+        min_=1, max_=100),
+})
+
+
+def main():
+    assert by_hand(BODY) == schema(BODY)
+
+    print "%10s %14s" % ('', 'time (us)')
+    for name, check in [
+            ('by hand', lambda: by_hand(BODY)),
+            ('schema', lambda: schema(BODY))]:
+        elapsed = min(timeit.repeat(check, number=REPEAT, repeat=3))
+        print "%10s %14.2f" % (name, elapsed * 1e6 / REPEAT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+""" Peak memory taking a large JSON array of records.
+
+    python -m benchmarks.stream
+
+    "JsonBody" decodes the whole body, "RecordStream" handles and drops
+    one record at a time. Each runs in its own process so the peak RSS
+    (in MB) is its own.
+"""
+
+import resource
+import subprocess
+import sys
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+import nudge.arg as args
+from nudge.publisher import WSGIRequest
+
+RECORDS = 200000
+
+
+def _body():
+    return '[' + ','.join(
+        '{"id": %d, "name": "record %d", "tags": ["a", "b"], "score": %d.5}'
+        % (i, i, i % 100) for i in xrange(RECORDS)) + ']'
+
+
+def run(name):
+    body = _body()
+    req = WSGIRequest({
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO.StringIO(body),
+    })
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    total = 0
+    if name == 'JsonBody':
+        for record in args.JsonBody().argspec(req, None):
+            total += record['id']
+    else:
+        for record in args.RecordStream().argspec(req, None):
+            total += record['id']
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    assert total == RECORDS * (RECORDS - 1) / 2
+    print "%12s %14.1f %14.1f" % (name, len(body) / 1e6,
+                                  (after - before) / 1024.0)
+
+
+def main():
+    print "%12s %14s %14s" % ('', 'body (MB)', 'peak +RSS (MB)')
+    sys.stdout.flush()
+    for name in ('JsonBody', 'RecordStream'):
+        subprocess.check_call(
+            [sys.executable, '-m', 'benchmarks.stream', name])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run(sys.argv[1])
+    else:
+        main()
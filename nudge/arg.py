@@ -16,10 +16,12 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import csv
 import types
 import nudge
+import nudge.json
 import nudge.validator as validate
-from nudge.utils import dehump
+from nudge.utils import dehump, iter_lines
 
 __all__ = [
     'Arg',
@@ -36,16 +38,29 @@ __all__ = [
     'Action',
     'JsonBody',
     'JsonBodyField',
+    'RecordStream',
     'List',
+    'IntegerList',
     'Dict',
 ]
 
 class Arg(object):
-
-    def __init__(self, name, optional=False, default=None, validator=None):
+    # query string args come in as lists, args that don't take a list only
+    # get the first value
+    takes_list = False
+    # args that read the whole body, it's read before a multipart body is
+    # parsed so the parts come from the copy instead of wsgi.input
+    reads_body = False
+
+    def __init__(self, name, optional=False, default=None, validator=None,
+                 memoize=False):
         # Are these class members unnecessary when using the below func?
         self.name = name
         self.optional = optional
+        # memoize caches a pure validator's results (validator.Memoize) for
+        # values that repeat across requests, eg. dates in query strings
+        if memoize and validator:
+            validator = validate.Memoize(validator)
         self.validator = validator
         self.default = default
         def func(req, inargs):
@@ -77,7 +92,7 @@ class Arg(object):
                 )
             # Query string args will come in list format, take the first.
             # Unless of course we are expecting a list from the json body.
-            if type(data) in [types.ListType] and not isinstance(self, List):
+            if type(data) in [types.ListType] and not self.takes_list:
                 data = data[0]
             try:
                 return self.validator(data)
@@ -90,6 +105,9 @@ class Arg(object):
                     msg += ': %s' % e.message
                     raise nudge.publisher.HTTPException(400, msg)
         self.argspec = func
+        # lets Endpoint tell an untouched argspec from a custom one, and
+        # bind the arg without calling it
+        self.plain_argspec = func
 
 class CustomArg(Arg):
 
@@ -115,26 +133,52 @@ class String(Arg):
             validator=validator
         )
 
+def _with_schema(validator, schema):
+    if schema is None:
+        return validator
+    check = validate.Schema(schema)
+    return lambda s: check(validator(s))
+
 class Dict(Arg):
+    """ A dict, schema is an optional validator.Schema spec for its
+        contents """
 
     def __init__(self, name, min_=None, max_=None,
-                 optional=False):
+                 optional=False, schema=None):
         super(Dict, self).__init__(
             name,
             optional,
             default=None,
-            validator=validate.Dict(min_, max_)
+            validator=_with_schema(validate.Dict(min_, max_), schema)
         )
 
 class List(Arg):
+    """ A list, schema is an optional validator.Schema spec for the whole
+        list, eg. [validator.Int()] """
+    takes_list = True
 
     def __init__(self, name, min_=None, max_=None,
-                 optional=False):
+                 optional=False, schema=None):
         super(List, self).__init__(
             name,
             optional,
             default=None,
-            validator=validate.List(min_, max_)
+            validator=_with_schema(validate.List(min_, max_), schema)
+        )
+
+class IntegerList(Arg):
+    """ Many integers at once, eg. ids from ?id=1,2,3&id=4 or a JSON list,
+        as an array.array('l') (see validator.IntegerList). min_ and max_
+        bound every value, max_count the number of them. """
+    takes_list = True
+
+    def __init__(self, name, min_=None, max_=None, max_count=None,
+                 optional=False, use_numpy=False):
+        super(IntegerList, self).__init__(
+            name,
+            optional,
+            default=None,
+            validator=validate.IntegerList(min_, max_, max_count, use_numpy)
         )
 
 class Boolean(Arg):
@@ -149,25 +193,29 @@ class Boolean(Arg):
 
 class Date(Arg):
 
-    def __init__(self, name, default=None, optional=False):
+    def __init__(self, name, default=None, optional=False, memoize=False):
         super(Date, self).__init__(
             name,
             optional,
             default,
-            validate.Date()
+            validate.Date(),
+            memoize=memoize
         )
 
 class DateTime(Arg):
 
-    def __init__(self, name, default=None, optional=False):
+    def __init__(self, name, default=None, optional=False, memoize=False):
         super(DateTime, self).__init__(
             name,
             optional,
             default,
-            validate.DateTime()
+            validate.DateTime(),
+            memoize=memoize
         )
 
 class Json(Arg):
+    """ A decoded JSON value. It can't be memoized, the dicts and lists
+        it decodes to are the handler's to change. """
 
     def __init__(self, name, default=None, optional=False):
         super(Json, self).__init__(
@@ -225,8 +273,8 @@ class Cookie(CustomArg):
             Right now just return the first item of the list
             (no support for multivalued cookies)
             '''
-            cook = req.cookies.get(cookie)
-            if cook and len(cook) >= 1:
+            cook = req.cookie_values(cookie)
+            if cook:
                 return cook[0]
             # Else we return None :)
         self.argspec = func
@@ -241,26 +289,34 @@ class Action(Arg):
 
 
 class UploadedFile(CustomArg):
+    """ An uploaded file as an open file, the request closes (and deletes)
+        it once the response is done. """
 
     def __init__(self, name):
         def func(req, inargs):
+            # req.files is filled when the body is parsed into arguments
+            req.arguments
             f = req.files[name]
+            f.file.seek(0)
             return {
                 'filename': f.filename,
-                'data': f.value,
+                'file': f.file,
+                'size': f.size,
+                'digest': f.digest,
                 'content_type': f.type,
             }
         self.argspec = func
 
 
 class Body(Arg):
+    reads_body = True
 
     def __init__(self, name=None, optional=False):
         self.name = name
         self.optional = optional
 
     def argspec(self, req, inargs):
-        if not req.body:
+        if not req.body_size():
             if self.optional:
                 return None
             else:
@@ -283,9 +339,12 @@ class JsonBody(CustomArg):
         You might use this in the case where you want the json body object
         as a single arg (maybe the body is very large)
     """
-    def __init__(self, optional=False, extend={}):
+    reads_body = True
+
+    def __init__(self, optional=False, extend={}, schema=None):
+        check = schema is not None and validate.Schema(schema) or None
         def func(req, inargs):
-            if not req.body:
+            if not req.body_size():
                 if optional:
                     return None
                 else:
@@ -294,6 +353,14 @@ class JsonBody(CustomArg):
                         "json body is not optional"
                     )
             json_body = _get_json_body(req)
+            if check:
+                try:
+                    json_body = check(json_body)
+                except (validate.ValidationError), e:
+                    raise nudge.publisher.HTTPException(
+                        400,
+                        "invalid json body: %s" % e.message
+                    )
             if extend:
                 return dict(json_body, **extend)
             return json_body
@@ -307,6 +374,8 @@ class JsonBodyField(CustomArg):
         application/json, the json body will be decoded and added to the arg
         dict (so you dont need to use this, you can use normal args).
     """
+    reads_body = True
+
     def __init__(self, fieldname, optional=False, validator=None):
         self.name = fieldname
         def func(req, inargs):
@@ -325,18 +394,76 @@ class JsonBodyField(CustomArg):
         self.argspec = func
 
 
-def _get_json_body(req):
-    """ decode and cache json body """
-
-    if '_body_dict' in req.arguments:
-        return req.arguments['_body_dict']
+_stream_formats = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'application/x-jsonlines': 'ndjson',
+    'text/csv': 'csv',
+}
+
+class RecordStream(CustomArg):
+    """ The records in a (possibly huge) body as a generator, read from
+        the request as they are asked for so only about one is in memory.
+        The body is a JSON array, newline delimited JSON or CSV with a
+        header row (records are dicts keyed by it). format is 'json',
+        'ndjson' or 'csv', by default it comes from the Content-Type.
+
+        validator (eg. validator.Schema) is applied to each record. A
+        malformed or invalid record raises a 400 out of the generator, so
+        the endpoint should not have committed to anything it can't undo
+        by then. Other args should come from the path or query string,
+        the body is no longer there for them.
+    """
+    streams_body = True
 
-    if not req.body:
-        return None
+    def __init__(self, format=None, validator=None, optional=False):
+        assert format in (None, 'json', 'ndjson', 'csv'), \
+            "format must be one of json, ndjson or csv"
+        def func(req, inargs):
+            if req.content_length() == 0:
+                if optional:
+                    return None
+                raise nudge.publisher.HTTPException(400, "body is required")
+            fmt = format
+            if fmt is None:
+                content_type = req.headers.get('Content-Type', '')
+                fmt = _stream_formats.get(
+                    content_type.split(';', 1)[0].strip().lower(), 'json')
+            stream = req.body_stream()
+            if fmt == 'ndjson':
+                records = nudge.json.iter_ndjson(stream)
+            elif fmt == 'csv':
+                records = csv.DictReader(iter_lines(stream))
+            else:
+                records = nudge.json.iter_json_array(stream)
+            return _checked_records(records, validator)
+        self.argspec = func
 
+def _checked_records(records, validator):
+    index = 0
     try:
-        body = nudge.json.json_decode(req.body)
-        req.arguments['_body_dict'] = body # cache it
-        return body
-    except (ValueError):
-        raise nudge.publisher.HTTPException(400, "body is not JSON")
+        for record in records:
+            if validator:
+                record = validator(record)
+            yield record
+            index += 1
+    except (validate.ValidationError), e:
+        raise nudge.publisher.HTTPException(
+            400,
+            "invalid record %d: %s" % (index, e.message)
+        )
+    except (TypeError), e:
+        # eg. a query string validator handed a JSON number
+        raise nudge.publisher.HTTPException(
+            400,
+            "invalid record %d" % index
+        )
+    except (ValueError, csv.Error), e:
+        raise nudge.publisher.HTTPException(
+            400,
+            "malformed body: %s" % e
+        )
+
+def _get_json_body(req):
+    """ the json body, decoded once by the request """
+    return req.json_body
@@ -25,6 +25,8 @@ import datetime
 import re
 import types
 
+from nudge.utils import iter_lines
+
 try:# We want to try to use simplejson first because it could have C-speedups
     from simplejson import JSONEncoder, JSONDecoder
 except ImportError:
@@ -44,6 +46,8 @@ __all__ = [
     'Encoder',
     'json_encode',
     'json_decode',
+    'iter_json_array',
+    'iter_ndjson',
     'JsonSerializable',
     'json_ensure_string_keys',
     'dehump',
@@ -65,12 +69,123 @@ _encoder = Encoder()
 def json_encode(o):
     return _encoder.encode(o)
 
-_decoder = JSONDecoder()
-def json_decode(o):
-    # remove tabs if they exists
-    o = o.replace('\t','')
-    data = _decoder.decode(o)
-    return data
+# strict decoding refuses control characters (eg. tabs) inside strings,
+# lenient decoding keeps them.
+_decoder = JSONDecoder(strict=False)
+_strict_decoder = JSONDecoder()
+def json_decode(o, strict=False):
+    if strict:
+        return _strict_decoder.decode(o)
+    return _decoder.decode(o)
+
+CHUNK_SIZE = 64 * 1024
+# Largest single element (or line) held while streaming
+MAX_ELEMENT_SIZE = 4 * 1024 * 1024
+_whitespace = re.compile(r'[ \t\n\r]*')
+# characters a number cut off at the end of a chunk may go on with
+_number_chars = frozenset('0123456789.eE+-')
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE,
+                    max_element_size=MAX_ELEMENT_SIZE):
+    ''' Decodes a top level JSON array read from stream, yielding its
+        elements one at a time. Only about one element is held in memory.
+        Raises ValueError for malformed input. '''
+    read = stream.read
+    raw_decode = _decoder.raw_decode
+    skip = _whitespace.match
+    buf = ''
+    pos = 0
+    eof = False
+    index = 0
+    while True:
+        pos = skip(buf, pos).end()
+        if pos < len(buf) or eof:
+            break
+        buf = read(chunk_size)
+        pos = 0
+        eof = not buf
+    if buf[pos:pos + 1] != '[':
+        raise ValueError("expected a JSON array")
+    pos += 1
+    first = True
+    while True:
+        pos = skip(buf, pos).end()
+        if pos == len(buf) and not eof:
+            chunk = read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        if buf[pos:pos + 1] == ']' and first:
+            pos += 1
+            break
+        try:
+            value, end = raw_decode(buf, pos)
+            # a value (a number especially) cut off by the end of the
+            # buffer may go on in the next chunk, and the , or ] after it
+            # has to be there too
+            after = skip(buf, end).end()
+            complete = eof or (after < len(buf) and
+                               buf[end] not in _number_chars)
+        except (ValueError):
+            if eof:
+                raise ValueError("malformed JSON in array element %d" % index)
+            complete = False
+        if not complete:
+            size = len(buf) - pos
+            if size > max_element_size:
+                raise ValueError(
+                    "JSON array element %d is over %d bytes" %
+                    (index, max_element_size))
+            # Decode again once the element's bytes have about doubled,
+            # retrying on every chunk is quadratic in the element's size.
+            # Never read more than a byte past max_element_size for it.
+            wanted = min(max(size, chunk_size), max_element_size + 1 - size)
+            chunks = [buf[pos:]]
+            while wanted > 0:
+                chunk = read(chunk_size)
+                if not chunk:
+                    eof = True
+                    break
+                chunks.append(chunk)
+                wanted -= len(chunk)
+            buf = ''.join(chunks)
+            pos = 0
+            continue
+        yield value
+        index += 1
+        first = False
+        separator = buf[after:after + 1]
+        pos = after + 1
+        if separator == ']':
+            break
+        if separator != ',':
+            raise ValueError(
+                "expected , or ] after array element %d" % (index - 1))
+    # only whitespace may follow the array
+    while True:
+        pos = skip(buf, pos).end()
+        if pos < len(buf):
+            raise ValueError("unexpected data after the JSON array")
+        if eof:
+            return
+        buf = read(chunk_size)
+        pos = 0
+        eof = not buf
+
+def iter_ndjson(stream, chunk_size=CHUNK_SIZE,
+                max_element_size=MAX_ELEMENT_SIZE):
+    ''' Decodes newline delimited JSON from stream, yielding one value per
+        line and skipping blank lines. Raises ValueError for malformed
+        lines. '''
+    for number, line in enumerate(
+            iter_lines(stream, chunk_size, max_element_size)):
+        if not line.strip():
+            continue
+        try:
+            yield _decoder.decode(line)
+        except (ValueError):
+            raise ValueError("malformed JSON on line %d" % (number + 1))
 
 class JsonSerializable(object):
 
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import cgi
+import hashlib
+import tempfile
+
+__all__ = [
+    'FormFile',
+    'MultipartError',
+    'parse_multipart',
+]
+
+""" Incremental multipart/form-data parsing.
+
+    The body is read chunk_size bytes at a time and never held whole. File
+    parts go straight to a temporary file with their size and md5 worked
+    out along the way, only the other (small) fields are kept in memory.
+    Both CRLF and bare LF line endings are accepted.
+"""
+
+CHUNK_SIZE = 64 * 1024
+# Largest header block of a part
+MAX_HEADER_SIZE = 16 * 1024
+# Largest non-file field, they are kept in memory
+MAX_FIELD_SIZE = 1024 * 1024
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class FormFile(object):
+    ''' A file part of a multipart body. file is a temporary file rewound to
+        the start of the data, digest the md5 hexdigest of it. '''
+
+    def __init__(self, name, filename, content_type, headers):
+        self.name = name
+        self.filename = filename
+        self.type = content_type
+        self.headers = headers
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.digest = None
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self._md5.update(data)
+
+    def finish(self):
+        self.digest = self._md5.hexdigest()
+        self._md5 = None
+        self.file.flush()
+        self.file.seek(0)
+
+    @property
+    def value(self):
+        ''' The whole file as a str, this reads it all into memory '''
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class _Field(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise MultipartError("form field over %d bytes" % self.max_size)
+        self.chunks.append(data)
+
+
+def parse_multipart(stream, boundary, chunk_size=CHUNK_SIZE,
+                    max_field_size=MAX_FIELD_SIZE):
+    ''' Reads a multipart/form-data body from stream. Returns (fields, files)
+        where fields maps names to str values (a list of them for repeated
+        names) and files maps names to FormFiles. Raises MultipartError
+        for malformed bodies. '''
+    if not boundary or len(boundary) > 200:
+        raise MultipartError("bad multipart boundary")
+    parser = _Parser(stream, boundary, chunk_size, max_field_size)
+    try:
+        parser.parse()
+    except:
+        for part in parser.files.itervalues():
+            part.close()
+        raise
+    return parser.fields, parser.files
+
+
+class _Parser(object):
+
+    def __init__(self, stream, boundary, chunk_size, max_field_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_field_size = max_field_size
+        self.separator = '\n--' + boundary
+        # the body may start with the first delimiter, a leading newline
+        # makes it look like every other one
+        self.buf = '\n'
+        self.eof = False
+        self.fields = {}
+        self.files = {}
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def _read_to_separator(self, write):
+        ''' Passes everything up to the next delimiter to write, less the
+            line ending before it, and drops the delimiter '''
+        separator = self.separator
+        # enough to hold back a separator split across reads and its '\r'
+        keep = len(separator) + 1
+        while True:
+            index = self.buf.find(separator)
+            if index >= 0:
+                data = self.buf[:index]
+                if data.endswith('\r'):
+                    data = data[:-1]
+                if write and data:
+                    write(data)
+                self.buf = self.buf[index + len(separator):]
+                return
+            if len(self.buf) > keep:
+                if write:
+                    write(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            if not self._fill():
+                raise MultipartError("multipart body ended without a boundary")
+
+    def _line(self):
+        while True:
+            index = self.buf.find('\n')
+            if index >= 0:
+                line = self.buf[:index]
+                self.buf = self.buf[index + 1:]
+                if line.endswith('\r'):
+                    line = line[:-1]
+                return line
+            if len(self.buf) > MAX_HEADER_SIZE:
+                raise MultipartError("multipart header line too long")
+            if not self._fill():
+                raise MultipartError("multipart body ended in a header")
+
+    def _headers(self):
+        headers = {}
+        size = 0
+        while True:
+            line = self._line()
+            if not line:
+                return headers
+            size += len(line)
+            if size > MAX_HEADER_SIZE:
+                raise MultipartError("multipart headers too long")
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise MultipartError("bad multipart header: %r" % line)
+            headers[name.strip().lower()] = value.strip()
+
+    def parse(self):
+        # anything before the first delimiter is a preamble
+        self._read_to_separator(None)
+        while True:
+            while len(self.buf) < 2 and self._fill():
+                pass
+            if self.buf.startswith('--'):
+                # closing delimiter, the epilogue is ignored
+                return
+            # the rest of the delimiter line is transport padding
+            self._line()
+            headers = self._headers()
+            disposition, params = cgi.parse_header(
+                headers.get('content-disposition', ''))
+            name = params.get('name')
+            if disposition != 'form-data' or name is None:
+                raise MultipartError("multipart part is not form-data")
+            if 'filename' in params:
+                part = FormFile(name, params['filename'],
+                    headers.get('content-type', 'application/octet-stream'),
+                    headers)
+                previous = self.files.get(name)
+                self.files[name] = part
+                if previous:
+                    previous.close()
+                self._read_to_separator(part.write)
+                part.finish()
+            else:
+                field = _Field(self.max_field_size)
+                self._read_to_separator(field.write)
+                value = ''.join(field.chunks)
+                if name not in self.fields:
+                    self.fields[name] = value
+                elif isinstance(self.fields[name], list):
+                    self.fields[name].append(value)
+                else:
+                    self.fields[name] = [self.fields[name], value]
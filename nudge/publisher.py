@@ -18,8 +18,10 @@
 
 import cgi
 import logging
+import mmap
 import re
 import sys
+import tempfile
 import time
 import types
 import urllib
@@ -28,12 +30,15 @@ try:
     import cStringIO as StringIO
 except ImportError:
     import StringIO
-from functools import partial
 
 import nudge.json
 import nudge.log
-from nudge.renderer import Json, RequestAwareRenderer
+import nudge.validator
+from nudge.renderer import Json, RequestAwareRenderer, Written
 from nudge.json import Dictomatic
+from nudge.multipart import parse_multipart
+from nudge.router import Router
+from nudge.utils import LRUCache
 from nudge.error import handle_exception, HTTPException, JsonErrorHandler,\
     DEFAULT_ERROR_CODE, DEFAULT_ERROR_CONTENT_TYPE, DEFAULT_ERROR_CONTENT, responses
 
@@ -46,13 +51,18 @@ __all__ = [
     'ServicePublisher',
 ]
 
+# Value of a lazyprop that hasn't been computed yet
+_UNSET = object()
+
 def lazyprop(fn):
     attr_name = '_lazy_' + fn.__name__
     @property
     def _lazyprop(self):
-        if not hasattr(self, attr_name):
-            setattr(self, attr_name, fn(self))
-        return getattr(self, attr_name)
+        value = getattr(self, attr_name, _UNSET)
+        if value is _UNSET:
+            value = fn(self)
+            setattr(self, attr_name, value)
+        return value
     return _lazyprop
 
 def Args(*args, **kwargs):
@@ -63,7 +73,7 @@ class Endpoint(object):
     named = {}
 
     def __init__(self, name=None, method=None, uri=None, uris=None,
-                 function=None, args=None, renderer=None):
+                 function=None, args=None, renderer=None, max_body_size=None):
         # Someday support unicode here, for now only bytestrings.
         assert isinstance(name, str)
         assert isinstance(method, str)
@@ -72,6 +82,9 @@ class Endpoint(object):
             "Endpoints must have either a uri or uris, but not both"
         assert callable(function) or isinstance(function, str), \
             "function must be callable or a string, but was %s" % type(function)
+        assert max_body_size is None or \
+            (isinstance(max_body_size, int) and max_body_size > 0), \
+            "max_body_size must be an int > 0"
 
         # TODO completely remove exceptions from endpoints.
         # assert not exceptions or isinstance(exceptions, dict), \
@@ -81,6 +94,9 @@ class Endpoint(object):
         self.method = method
         self.uris = [uri] if uri else uris
         self.function = function
+        # Replaces the publisher's max_body_size for this endpoint, higher
+        # or lower
+        self.max_body_size = max_body_size
         if args:
             self.sequential, self.named = args
             assert not self.sequential or isinstance(self.sequential, list), \
@@ -88,6 +104,8 @@ class Endpoint(object):
                 type(self.sequential)
             assert not self.named or isinstance(self.named, dict), \
                 "named must be a dict, but was type %s" % type(self.named)
+        # bind(req, path_args) returns the (args, kwargs) to call with
+        self.bind = _compile_binder(self.sequential or [], self.named or {})
 
         # TODO remove this fully later
         self.exceptions = None
@@ -117,53 +135,643 @@ class Endpoint(object):
     def __call__(self, *args, **kwargs):
         return self.function(*args, **kwargs)
 
+
+def _no_args(req, path_args):
+    return [], {}
+
+def _compile_binder(sequential, named):
+    ''' Turns an endpoint's args into one function of (req, path_args) that
+        returns its (args, kwargs). Plain Args (validator and all, as set up
+        by Arg.__init__) are looked up right here, the same way their
+        argspec would. Everything else, CustomArgs included, still gets its
+        argspec called with the inargs view. '''
+    steps = []
+    for keyword, arg in [(None, arg) for arg in sequential] + \
+            named.items():
+        if getattr(arg, 'plain_argspec', None) is arg.argspec and \
+                arg.validator:
+            steps.append((keyword, True, (
+                arg.name, arg.optional, arg.default, arg.validator,
+                arg.takes_list)))
+        else:
+            steps.append((keyword, False, arg.argspec))
+    if not steps:
+        return _no_args
+    # an arg that streams the body claims it before any other arg can get
+    # req.arguments to read it whole
+    streams_body = any(getattr(arg, 'streams_body', False)
+                       for arg in sequential + named.values())
+    reads_body = not streams_body and any(
+        getattr(arg, 'reads_body', False)
+        for arg in sequential + named.values())
+
+    ValidationError = nudge.validator.ValidationError
+    def binder(req, path_args):
+        if streams_body:
+            req.body_stream()
+        elif reads_body:
+            req.body_size()
+        args = []
+        kwargs = {}
+        arguments = inargs = None
+        for keyword, plain, spec in steps:
+            if plain:
+                name, optional, default, validator, takes_list = spec
+                if arguments is None:
+                    arguments = req.arguments
+                exists = True
+                if arguments and name in arguments:
+                    data = arguments[name]
+                elif name in path_args:
+                    # the request arguments were checked above, so only the
+                    # path args can still hold it
+                    data = path_args[name]
+                else:
+                    exists = False
+                    data = None
+                if not data:
+                    if not optional:
+                        if exists:
+                            msg = " is required, exists, but is empty"
+                        else:
+                            msg = " is required but does not exist"
+                        raise HTTPException(400, name + msg)
+                    value = default
+                else:
+                    # Query string args come in as lists, take the first.
+                    if type(data) is types.ListType and not takes_list:
+                        data = data[0]
+                    try:
+                        value = validator(data)
+                    except (ValidationError), e:
+                        value = None
+                        if e.message:
+                            raise HTTPException(400,
+                                "invalid value for argument '%s': '%s': %s" %
+                                (name, data, e.message))
+            else:
+                if inargs is None:
+                    inargs = _InArgs(req, path_args)
+                value = spec(req, inargs)
+            if keyword is None:
+                args.append(value)
+            elif value != None:
+                kwargs[keyword] = value
+        return args, kwargs
+    return binder
+
+_BODY_CHUNK_SIZE = 64 * 1024
+
+# Parsed query strings, polling clients send the same ones over and over
+_query_cache = LRUCache(256)
+# Longer query strings aren't worth caching
+_MAX_CACHED_QUERY = 1024
+
+def parse_query_string(query):
+    ''' Parses a QUERY_STRING into a dict of unicode names to lists of
+        unicode values. Only name=value pairs are kept, f= stays as
+        [u''] but f or f=a=b are dropped, as are pairs that aren't utf-8. '''
+    cacheable = len(query) <= _MAX_CACHED_QUERY
+    if cacheable:
+        pairs = _query_cache.get(query)
+        if pairs is not None:
+            arguments = {}
+            for k, v in pairs:
+                if k in arguments:
+                    arguments[k].append(v)
+                else:
+                    arguments[k] = [v]
+            return arguments
+    arguments = {}
+    pairs = []
+    # split before unquoting to handle names/values that contain & or =
+    for pair in query.split('&'):
+        k, sep, v = pair.partition('=')
+        if not sep or '=' in v:
+            continue
+        if '%' in pair or '+' in pair:
+            k = urllib.unquote_plus(k)
+            v = urllib.unquote_plus(v)
+        # Consider making the unicode decoding type a Nudge option.
+        try:
+            k = k.decode('utf-8')
+            v = v.decode('utf-8')
+        except (UnicodeDecodeError):
+            _log.debug("skipping query string pair that isn't utf-8: %r",
+                pair)
+            continue
+        pairs.append((k, v))
+        if k in arguments:
+            arguments[k].append(v)
+        else:
+            arguments[k] = [v]
+    if cacheable:
+        _query_cache[query] = tuple(pairs)
+    return arguments
+
+# backslash escapes in quoted cookie values, octal ones (\073) included
+_cookie_escape = re.compile(r'\\(?:([0-3][0-7][0-7])|(.))')
+
+def _unquote_cookie(value):
+    return _cookie_escape.sub(
+        lambda m: m.group(1) and chr(int(m.group(1), 8)) or m.group(2),
+        value[1:-1])
+
+def _cookie_value(header, pos):
+    ''' Returns the cookie value starting at pos and the index of the ';'
+        after it (or the end of header) '''
+    end = len(header)
+    while pos < end and header[pos] in ' \t':
+        pos += 1
+    if pos < end and header[pos] == '"':
+        close = pos + 1
+        while close < end and header[close] != '"':
+            if header[close] == '\\':
+                close += 1
+            close += 1
+        if close < end:
+            semi = header.find(';', close)
+            if semi < 0:
+                semi = end
+            return _unquote_cookie(header[pos:close + 1]), semi
+    semi = header.find(';', pos)
+    if semi < 0:
+        semi = end
+    return header[pos:semi].strip(), semi
+
+def parse_cookies(header, only=None):
+    ''' Parses a Cookie header into a dict of names to lists of values.
+        Values are split from names on the first '=', pairs without one are
+        dropped and double quoted values are unquoted. '''
+    cookies = {}
+    if '"' not in header:
+        for pair in header.split(';'):
+            name, sep, value = pair.partition('=')
+            if not sep:
+                continue
+            name = name.strip()
+            if only is None or name == only:
+                cookies.setdefault(name, []).append(value.strip())
+        return cookies
+    pos = 0
+    end = len(header)
+    while pos < end:
+        semi = header.find(';', pos)
+        if semi < 0:
+            semi = end
+        eq = header.find('=', pos, semi)
+        if eq < 0:
+            pos = semi + 1
+            continue
+        name = header[pos:eq].strip()
+        value, semi = _cookie_value(header, eq + 1)
+        if only is None or name == only:
+            cookies.setdefault(name, []).append(value)
+        pos = semi + 1
+    return cookies
+
+def cookie_values(header, name):
+    ''' The values of just one cookie in a Cookie header, without splitting
+        up the rest of it '''
+    if not name or name not in header:
+        return []
+    if '"' in header:
+        # a quoted value could hide a '; name=' of its own
+        return parse_cookies(header, only=name).get(name, [])
+    values = []
+    size = len(name)
+    start = 0
+    while True:
+        index = header.find(name, start)
+        if index < 0:
+            return values
+        start = index + size
+        # the name has to be a whole name, between a ';' and an '='
+        before = index - 1
+        while before >= 0 and header[before] in ' \t':
+            before -= 1
+        if before >= 0 and header[before] != ';':
+            continue
+        after = start
+        while after < len(header) and header[after] in ' \t':
+            after += 1
+        if after >= len(header) or header[after] != '=':
+            continue
+        value, start = _cookie_value(header, after + 1)
+        values.append(value)
+
 def _write(req, content):
-    req._buffer += content
+    req.write(content)
+
+
+# header name => environ key, eg. X-Forwarded-For => HTTP_X_FORWARDED_FOR
+_header_keys = {}
+# values of a repeated header are joined with commas, except in quotes
+_header_split = re.compile(r'((?:[^,"]|"(?:[^"\\]|\\.)*")+)')
+
+class WSGIHeaders(object):
+    ''' Read only, case insensitive view of the request headers in a WSGI
+        environ. Each lookup goes straight to the environ key, nothing is
+        copied. '''
+    __slots__ = ('_environ',)
+
+    def __init__(self, environ):
+        self._environ = environ
 
+    @staticmethod
+    def normalize_name(n):
+        key = _header_keys.get(n)
+        if key is None:
+            key = n.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            _header_keys[n] = key
+        return key
+
+    def _lookup(self, name):
+        value = self._environ.get(WSGIHeaders.normalize_name(name))
+        if value is None:
+            # some servers keep the dashes, eg. HTTP_X-Forwarded-For
+            value = self._environ.get('HTTP_' + name)
+        return value
+
+    def __getitem__(self, name):
+        value = self._lookup(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._lookup(name) is not None
+
+    def get(self, name, default=None):
+        value = self._lookup(name)
+        if value is None:
+            return default
+        return value
+
+    def getlist(self, name):
+        ''' All values of a header, servers join repeated headers with a
+            comma so this splits on commas outside of quoted strings. Don't
+            use it for headers with commas in their values, eg. dates. '''
+        value = self._lookup(name)
+        if not value:
+            return []
+        return [v.strip() for v in _header_split.findall(value) if v.strip()]
+
+    def iteritems(self):
+        for k, v in self._environ.iteritems():
+            if k.startswith('HTTP_'):
+                yield k[5:].lower(), v
+            elif k in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                yield k.lower(), v
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [k for k, v in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
 
-class WSGIHeaders(dict):
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
 
-    def __init__(self, *args, **kwargs):
-        super(WSGIHeaders, self).__init__()
-        self.update(*args, **kwargs)
+
+class EnvironView(object):
+    ''' Read only view of a WSGI environ. Keys can be read as attributes,
+        missing ones are None like with Dictomatic. '''
+    __slots__ = ('_environ',)
+
+    def __init__(self, environ):
+        object.__setattr__(self, '_environ', environ)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._environ.get(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("environ view is read only")
 
     def __getitem__(self, key):
-        return super(WSGIHeaders, self).__getitem__(
-            WSGIHeaders.normalize_name(key)
-        )
+        return self._environ[key]
+
+    def __contains__(self, key):
+        return key in self._environ
+
+    def __iter__(self):
+        return iter(self._environ)
+
+    def __len__(self):
+        return len(self._environ)
+
+    def get(self, key, default=None):
+        return self._environ.get(key, default)
+
+    def keys(self):
+        return self._environ.keys()
+
+    def items(self):
+        return self._environ.items()
+
+    def iteritems(self):
+        return self._environ.iteritems()
+
+
+class _InArgs(object):
+    ''' The path args with the request arguments (lists made scalars) over
+        them. req.arguments is only parsed once an arg looks in here. It
+        stands in for the dict CustomArg.argspec used to get, so it has the
+        dict methods. '''
+    __slots__ = ('_req', '_path_args', '_merged')
+
+    def __init__(self, req, path_args):
+        self._req = req
+        self._path_args = path_args
+        self._merged = None
+
+    def _args(self):
+        if self._merged is None:
+            merged = dict(self._path_args)
+            for k, v in self._req.arguments.iteritems():
+                if isinstance(v, list) and len(v) > 0:
+                    merged[k] = v[0]
+            merged.pop('_method', None)
+            self._merged = merged
+        return self._merged
+
+    def __contains__(self, key):
+        return key in self._args()
+
+    def __getitem__(self, key):
+        return self._args()[key]
 
     def __setitem__(self, key, value):
-        return super(WSGIHeaders, self).__setitem__(
-            WSGIHeaders.normalize_name(key), value
-        )
+        self._args()[key] = value
+
+    def __delitem__(self, key):
+        del self._args()[key]
+
+    def __iter__(self):
+        return iter(self._args())
+
+    def __len__(self):
+        return len(self._args())
+
+    def __eq__(self, other):
+        if isinstance(other, _InArgs):
+            other = other._args()
+        return self._args() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._args())
+
+    def has_key(self, key):
+        return key in self._args()
 
     def get(self, key, default=None):
-        return super(WSGIHeaders, self).get(
-            WSGIHeaders.normalize_name(key), default
-        )
+        return self._args().get(key, default)
 
-    def set(self, key, value):
-        return super(WSGIHeaders, self).set(
-            WSGIHeaders.normalize_name(key), value
-        )
+    def copy(self):
+        return self._args().copy()
 
-    @staticmethod
-    def normalize_name(n):
-        return n.lower().replace('-','_')
+    def keys(self):
+        return self._args().keys()
+
+    def values(self):
+        return self._args().values()
+
+    def items(self):
+        return self._args().items()
+
+    def iterkeys(self):
+        return self._args().iterkeys()
+
+    def itervalues(self):
+        return self._args().itervalues()
+
+    def iteritems(self):
+        return self._args().iteritems()
+
+    def setdefault(self, key, default=None):
+        return self._args().setdefault(key, default)
+
+    def pop(self, key, *default):
+        return self._args().pop(key, *default)
+
+    def update(self, *args, **kwargs):
+        self._args().update(*args, **kwargs)
+
+
+class _BodyStream(object):
+    ''' wsgi.input limited to CONTENT_LENGTH, raising a 413 once more than
+        max_body_size bytes have been read '''
+
+    def __init__(self, req):
+        self._stream = req.req.get('wsgi.input')
+        self._limit = req.max_body_size
+        self._remaining = req.content_length()
+        if self._remaining is not None:
+            req.check_body_size()
+        self.size = 0
+
+    def read(self, size=-1):
+        if self._remaining is not None:
+            if size < 0 or size > self._remaining:
+                size = self._remaining
+            if not size:
+                return ''
+        if size < 0 and self._limit:
+            # no length, never hold more than one byte past the limit
+            size = self._limit + 1 - self.size
+        if size < 0:
+            chunk = self._stream.read()
+        else:
+            chunk = self._stream.read(size)
+        if self._remaining is not None:
+            self._remaining -= len(chunk)
+        self.size += len(chunk)
+        if self._limit and self.size > self._limit:
+            raise HTTPException(413)
+        return chunk
 
 
 class WSGIRequest(object):
+    __slots__ = (
+        'environ', 'req', 'start_time', 'method', 'remote_ip', '_buffer',
+        'files', 'max_body_size', 'spool_threshold',
+        '_lazy_body', '_body_file', '_body_size', '_body_map', '_body_stream',
+        '_lazy_path', '_lazy_uri', '_lazy_headers', '_lazy_cookies',
+        '_lazy_arguments', '_lazy_json_body', '_cookie_values',
+    )
 
     def __init__(self, req_dict):
-        # Should we use dictomatic here? (tiny slowdown)
-        # REVIEW: From the following items, it feels like we can remove the Dictomatic wrapper.
-        self.req = Dictomatic.wrap(req_dict)
+        # The environ itself, not a copy, with a read only attribute view
+        self.environ = req_dict
+        self.req = EnvironView(req_dict)
         self.start_time = time.time()
-        self.method = self.req.get('REQUEST_METHOD')
-        self.remote_ip = self.req.get('REMOTE_ADDR', self.req.get('HTTP_REMOTE_ADDR'))
-        self.body = self.req.get('wsgi.input').read()
-        self._buffer = ''
+        self.method = req_dict.get('REQUEST_METHOD')
+        self.remote_ip = req_dict.get('REMOTE_ADDR',
+                                      req_dict.get('HTTP_REMOTE_ADDR'))
+        # chunks passed to write(), None until there are any
+        self._buffer = None
         self.files = {}
+        # Bodies longer than this many bytes are refused with a 413, 0 is no
+        # limit
+        self.max_body_size = 0
+        # Bodies longer than this many bytes are spooled to a temporary file
+        self.spool_threshold = 1024 * 1024
+        self._lazy_body = None
+        self._body_file = None
+        self._body_size = None
+        self._body_map = None
+        self._body_stream = None
+        self._cookie_values = None
+        self._lazy_path = self._lazy_uri = self._lazy_headers = \
+            self._lazy_cookies = self._lazy_arguments = \
+            self._lazy_json_body = _UNSET
+
+    def close(self):
+        ''' Releases a body spooled to disk and any uploaded files '''
+        for upload in self.files.itervalues():
+            upload.close()
+        if self._body_map is not None:
+            self._body_map.close()
+            self._body_map = None
+        if self._body_file is not None:
+            self._body_file.close()
+            self._body_file = None
+
+    def _get_body(self):
+        if self._lazy_body is None:
+            self._lazy_body = self.body_file.read()
+        return self._lazy_body
+
+    def _set_body(self, body):
+        self._lazy_body = body
+        self._body_file = StringIO.StringIO(body)
+        self._body_size = len(body)
+
+    # The request body as a str, only read from wsgi.input on first use. For
+    # bodies spooled to disk this makes a copy, prefer body_file.
+    body = property(_get_body, _set_body)
+
+    def _get_body_file(self):
+        if self._body_file is None:
+            self._read_body()
+        self._body_file.seek(0)
+        return self._body_file
+
+    # The request body as a file rewound to the start
+    body_file = property(_get_body_file)
+
+    def body_read(self):
+        ''' True once something has consumed wsgi.input through body '''
+        return self._body_file is not None
+
+    def body_stream(self):
+        ''' The body as a file to read incrementally, straight from
+            wsgi.input and never held whole. Once this is used body and
+            friends are not available, if the body was already read this
+            is body_file. '''
+        if self._body_file is not None:
+            return self.body_file
+        if self._body_stream is None:
+            self._body_stream = _BodyStream(self)
+        return self._body_stream
+
+    def body_size(self):
+        ''' Length of the body in bytes, reading it if needed '''
+        if self._body_file is None:
+            self._read_body()
+        return self._body_size
+
+    def body_view(self):
+        ''' The body without copying it, a memoryview for bodies held in
+            memory and a buffer over an mmap for bodies spooled to disk '''
+        if self._lazy_body is not None or not self.body_size():
+            return memoryview(self.body)
+        if self._body_map is None:
+            self._body_map = mmap.mmap(
+                self.body_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return buffer(self._body_map)
+
+    def content_length(self):
+        ''' CONTENT_LENGTH as an int, or None if missing or invalid '''
+        try:
+            length = int(self.req.get('CONTENT_LENGTH') or '')
+        except (ValueError):
+            return None
+        if length < 0:
+            return None
+        return length
+
+    def check_body_size(self):
+        ''' Raises a 413 if the declared length is over max_body_size. This
+            doesn't touch wsgi.input, so servers that answer
+            Expect: 100-continue on first read never ask for the body. '''
+        length = self.content_length()
+        if self.max_body_size and length is not None and \
+                length > self.max_body_size:
+            raise HTTPException(413)
+
+    def _read_body(self):
+        ''' Reads wsgi.input into a str, or into a temporary file once it
+            grows past spool_threshold bytes '''
+        if self._body_stream is not None:
+            raise HTTPException(500, "the request body was streamed, it "
+                "can't be read whole")
+        stream = self.req.get('wsgi.input')
+        limit = self.max_body_size
+        remaining = self.content_length()
+        if remaining is None:
+            # No length (eg. chunked), read at most one byte past the limit
+            # so an oversized body is never held. -1 reads it all at once.
+            remaining = limit and limit + 1 or -1
+        else:
+            self.check_body_size()
+        chunks = []
+        spool = None
+        size = 0
+        while remaining:
+            if remaining > 0:
+                chunk = stream.read(min(remaining, _BODY_CHUNK_SIZE))
+                remaining -= len(chunk)
+            else:
+                chunk = stream.read()
+                remaining = 0
+            if not chunk:
+                break
+            size += len(chunk)
+            if limit and size > limit:
+                if spool:
+                    spool.close()
+                raise HTTPException(413)
+            if spool:
+                spool.write(chunk)
+            elif size > self.spool_threshold:
+                spool = tempfile.TemporaryFile()
+                spool.writelines(chunks)
+                spool.write(chunk)
+                chunks = None
+            else:
+                chunks.append(chunk)
+        self._body_size = size
+        if spool:
+            spool.flush()
+            self._body_file = spool
+        else:
+            # reading from a cStringIO made from a str doesn't copy it
+            self._lazy_body = ''.join(chunks)
+            self._body_file = StringIO.StringIO(self._lazy_body)
 
     @lazyprop
     def path(self):
@@ -179,13 +787,7 @@ class WSGIRequest(object):
 
     @lazyprop
     def headers(self):
-        _headers = WSGIHeaders()
-        for k,v in self.req.iteritems():
-            if k.startswith('HTTP_'):
-                _headers[k.replace('HTTP_', '').lower()] = v
-            elif k == 'CONTENT_TYPE':
-                _headers['Content-Type'] = v
-        return _headers
+        return WSGIHeaders(self.environ)
 
     @lazyprop
     def cookies(self):
@@ -198,86 +800,104 @@ class WSGIRequest(object):
         TODO - support/test with unicode?
              - Maybe nuke the HTTP_COOKIE from regular headers?
         '''
-        _cookies = {}
-        if 'HTTP_COOKIE' in self.req:
-            for cookie in self.req['HTTP_COOKIE'].split(';'):
-                cookie = cookie.split('=')
-                if len(cookie) < 2: # Empty values will still be >= 2
-                    continue
-                if cookie[0] in _cookies:
-                    _cookies[cookie[0].strip()].append(
-                        '='.join(cookie[1:]).strip()
-                    )
-                else:
-                    _cookies[cookie[0].strip()] = ['='.join(cookie[1:]).strip()]
-        return _cookies
+        return parse_cookies(self.environ.get('HTTP_COOKIE', ''))
+
+    def cookie_values(self, name):
+        ''' All values of the named cookie. Only that name is looked for in
+            the Cookie header, the result is remembered. '''
+        if self._lazy_cookies is not _UNSET:
+            return self._lazy_cookies.get(name, [])
+        if self._cookie_values is None:
+            self._cookie_values = {}
+        values = self._cookie_values.get(name)
+        if values is None:
+            values = self._cookie_values[name] = cookie_values(
+                self.environ.get('HTTP_COOKIE', ''), name)
+        return values
+
+    @lazyprop
+    def json_body(self):
+        ''' The body decoded as JSON, or None without a body. It's decoded
+            once, arguments and the JsonBody args all share it. '''
+        if not self.body_size():
+            return None
+        try:
+            return nudge.json.json_decode(self.body)
+        except (ValueError):
+            raise HTTPException(400, "body is not JSON")
 
     @lazyprop
     def arguments(self):
         _arguments = {}
         _files = {}
         try:
-            # First url decode
-            tmp = self.req.get('QUERY_STRING', '')
-            if tmp:
-                # make sure to split before unquoting
-                # to handle arg keys/values that contain & or =
-                tmp = tmp.split('&')
-                tmp = [a.split('=') for a in tmp]
-                tmp = [map(urllib.unquote_plus, a) for a in tmp]
-                # Consider making the unicode decoding type a Nudge option.
-                tmp = [map(partial(unicode, encoding='utf-8'), a) for a in tmp]
-                # Only keep args with k and v. f= will stay and be [u'f', u'']
-                tmp = filter(lambda x: len(x) == 2, tmp)
-                for k, v in tmp:
-                    if k in _arguments:
-                        _arguments[k].append(v)
-                    else:
-                        _arguments[k] = [v]
+            query = self.req.get('QUERY_STRING', '')
+            if query:
+                _arguments = parse_query_string(query)
         except (Exception), e:
             _log.exception(
                 "problem making arguments out of QUERY_STRING: %s",
                 self.req['QUERY_STRING']
             )
 
-        if self.method in ('POST', 'PUT') and self.body:
+        content_type = ''
+        if self.method in ('POST', 'PUT') and self._body_stream is None:
             content_type = self.headers.get("Content-Type", '')
+        # multipart form
+        if content_type.startswith("multipart/form-data") and \
+                self.content_length() != 0:
+            # parsed straight from wsgi.input unless something already read
+            # the body, so large uploads only go to disk once
+            if self._body_file is None:
+                stream = self.body_stream()
+            else:
+                stream = self.body_file
+            try:
+                boundary = cgi.parse_header(content_type)[1].get(
+                    'boundary', '')
+                fields, _files = parse_multipart(stream, boundary)
+                _arguments.update(fields)
+                # uploads are only passed around as FormFiles, never
+                # read into memory
+                _arguments.update(_files)
+            except (HTTPException):
+                raise
+            except:
+                _log.exception(
+                    "problem parsing multipart/form-data"
+                )
+        # only these bodies are read for arguments, others are left alone
+        # for the args that want them
+        elif content_type.startswith("application/x-www-form-urlencoded"):
             # TODO make sure these come out as unicode
-            if content_type.startswith("application/x-www-form-urlencoded"):
+            if self.body_size():
                 for name, values in cgi.parse_qs(self.body).iteritems():
                     _arguments.setdefault(name, []).extend(values)
-            # multipart form
-            elif content_type.startswith("multipart/form-data"):
-                try:
-                    fs = cgi.FieldStorage(
-                        fp=StringIO.StringIO(self.body),
-                        environ=self.req,
-                        keep_blank_values=1
-                    )
-                    for k in fs.keys():
-                        part = fs[k]
-                        if part.filename:
-                            _files[k] = part
-                        _arguments[k] = part.value
-                except:
-                    _log.exception(
-                        "problem parsing multipart/form-data"
-                    )
-            # add any arguments from JSON body
-            elif content_type.startswith("application/json"):
-                try:
-                    body = nudge.json.json_decode(self.body)
-                    if isinstance(body, types.DictType):
-                        _arguments = dict(_arguments, **body)
-
-                except (ValueError):
-                    raise HTTPException(400, "body is not JSON")
+        # add any arguments from JSON body
+        elif content_type.startswith("application/json"):
+            body = self.json_body
+            if isinstance(body, types.DictType):
+                _arguments = dict(_arguments, **body)
 
         self.files = _files
         return _arguments
 
     def write(self, content):
-        self._buffer += content
+        ''' Buffers content to go out as the response body, for endpoints
+            with the Written renderer. It's dropped if the request ends in
+            an error. '''
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        if self._buffer is None:
+            self._buffer = [content]
+        else:
+            self._buffer.append(content)
+
+    def getvalue(self):
+        ''' Everything written so far as one str '''
+        if self._buffer is None:
+            return ''
+        return ''.join(self._buffer)
 
     def request_time(self):
         return time.time() - self.start_time
@@ -305,24 +925,44 @@ def redirect(uri, headers=None):
 class ServicePublisher(object):
 
     def __init__(self, fallbackapp=None, endpoints=None,
-                 debug=False, options=None, default_error_handler=None):
+                 debug=False, options=None, default_error_handler=None,
+                 hosts=None):
         # Note fallback app needs to be a wsgi-compatible callable
         if fallbackapp:
             assert callable(fallbackapp), "Fallback app must be callable"
         self._fallbackapp = fallbackapp
+        # requests handed to the fallback app with their original input, and
+        # with the body nudge had already read
+        self._fallback_passthrough = 0
+        self._fallback_rewound = 0
         self._debug = debug
         if self._debug:
             _log.setLevel(logging.DEBUG)
-        self._endpoints = []
-        if endpoints:
-            assert isinstance(endpoints, list), "endpoints must be a list"
-            for ep in endpoints:
-                self.add_endpoint(ep)
 
         if not default_error_handler:
             default_error_handler = JsonErrorHandler
         self._options = Dictomatic({
             "default_error_handler": default_error_handler,
+            # 405 instead of 404 for methods no endpoint uses
+            "method_not_allowed": False,
+            # number of (method, path) routing results to remember, 0 is off
+            "route_cache_size": 0,
+            # regex routes get reordered by popularity every this many regex
+            # dispatches, 0 is off. Each reorder rebuilds the combined
+            # regexes within a request.
+            "route_reorder_interval": 0,
+            # refuse uri regexes that can backtrack exponentially
+            "safe_routes": False,
+            # longest method + path matched against a risky uri regex, longer
+            # requests get a 414. 0 is no limit.
+            "max_risky_path_length": 2048,
+            # largest request body in bytes, larger ones get a 413 before
+            # being read. 0 is no limit. Endpoints can set their own, and
+            # the fallback app gets the body whatever its size.
+            "max_body_size": 0,
+            # request bodies larger than this many bytes are spooled to a
+            # temporary file instead of being held in memory
+            "spool_threshold": 1024 * 1024,
         })
 
         if options:
@@ -330,6 +970,30 @@ class ServicePublisher(object):
             self._options.update(options)
         self.verify_options()
 
+        self._route_cache = None
+        if self._options.route_cache_size:
+            self._route_cache = LRUCache(self._options.route_cache_size)
+        self._route_generation = 0
+        self._spool_threshold = self._options.spool_threshold
+        self._endpoints = []
+        self._router = self._new_router()
+        # per virtual host routers, by exact host name and for '*.' patterns
+        # by the parent domain
+        self._hosts = {}
+        self._wildcard_hosts = {}
+        if endpoints:
+            assert isinstance(endpoints, list), "endpoints must be a list"
+            for ep in endpoints:
+                self.add_endpoint(ep)
+        if hosts:
+            assert isinstance(hosts, dict), \
+                "hosts must be a dict of host pattern to endpoint list"
+            for host, host_endpoints in hosts.iteritems():
+                assert isinstance(host_endpoints, list), \
+                    "endpoints for host %s must be a list" % host
+                for ep in host_endpoints:
+                    self.add_endpoint(ep, host=host)
+
     def verify_options(self):
         msg = "Default exception handler "
         assert self._options.default_error_handler, msg + "must exist"
@@ -351,6 +1015,22 @@ class ServicePublisher(object):
             assert isinstance(v, str),\
                 msg + "headers keys and values must be a byte string"
 
+        assert isinstance(self._options.route_cache_size, int) and \
+            self._options.route_cache_size >= 0, \
+            "route_cache_size must be an int >= 0"
+        assert isinstance(self._options.route_reorder_interval, int) and \
+            self._options.route_reorder_interval >= 0, \
+            "route_reorder_interval must be an int >= 0"
+        assert isinstance(self._options.max_risky_path_length, int) and \
+            self._options.max_risky_path_length >= 0, \
+            "max_risky_path_length must be an int >= 0"
+        assert isinstance(self._options.max_body_size, int) and \
+            self._options.max_body_size >= 0, \
+            "max_body_size must be an int >= 0"
+        assert isinstance(self._options.spool_threshold, int) and \
+            self._options.spool_threshold >= 0, \
+            "spool_threshold must be an int >= 0"
+
         # Set default error params here incase of massive failure we fallback
         # to these.
         self._options.default_error_response = (
@@ -360,9 +1040,89 @@ class ServicePublisher(object):
             self._options.default_error_handler.headers,
         )
 
-    def add_endpoint(self, endpoint):
+    def add_endpoint(self, endpoint, host=None):
+        ''' Endpoints with a host are only routed for requests to that host.
+            The host may start with '*.' to take any one subdomain, eg.
+            '*.example.com'. Requests for hosts without any endpoints of
+            their own use the endpoints added without a host. '''
         assert isinstance(endpoint, Endpoint)
+        if host:
+            assert isinstance(host, str), "host must be a byte string"
+            host = host.lower()
+            hosts = self._hosts
+            if host.startswith('*.'):
+                host = host[2:]
+                hosts = self._wildcard_hosts
+            router = hosts.get(host)
+            if router is None:
+                router = hosts[host] = self._new_router()
+            router.add(endpoint)
+        else:
+            self._router.add(endpoint)
         self._endpoints.append(endpoint)
+        if self._route_cache is not None:
+            # anything cached so far may now route differently
+            self._route_generation += 1
+            self._route_cache.clear()
+
+    def stats(self):
+        stats = {}
+        if self._route_cache is not None:
+            stats['route_cache'] = self._route_cache.stats()
+        if self._fallbackapp:
+            stats['fallback'] = {
+                'passthrough': self._fallback_passthrough,
+                'rewound': self._fallback_rewound,
+            }
+        validator_cache = {}
+        for endpoint in self._endpoints:
+            for arg in (endpoint.sequential or []) + \
+                    (endpoint.named or {}).values():
+                if hasattr(getattr(arg, 'validator', None), 'stats'):
+                    validator_cache['%s.%s' % (endpoint.name, arg.name)] = \
+                        arg.validator.stats()
+        if validator_cache:
+            stats['validator_cache'] = validator_cache
+        return stats
+
+    def _new_router(self):
+        return Router(
+            reorder_interval=self._options.route_reorder_interval,
+            max_risky_length=self._options.max_risky_path_length,
+            safe=self._options.safe_routes,
+        )
+
+    def _host_router(self, environ):
+        ''' The route table for this request's Host header '''
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME') or ''
+        host = host.lower()
+        if ':' in host and not host.endswith(']'):
+            host = host.rpartition(':')[0]
+        host = host.rstrip('.')
+        router = self._hosts.get(host)
+        if router is None and self._wildcard_hosts:
+            router = self._wildcard_hosts.get(host.partition('.')[2])
+        return router or self._router
+
+    def _find_endpoint(self, router, method, path):
+        ''' Returns (endpoint, path_args) or (None, None) for this method and
+            raw (still quoted) PATH_INFO '''
+        cache = self._route_cache
+        if cache is None:
+            return router.match(method, urllib.unquote(path))
+        key = (router, method, path)
+        found = cache.get(key)
+        if found is None:
+            generation = self._route_generation
+            found = router.match(method, urllib.unquote(path))
+            if generation == self._route_generation:
+                cache[key] = found
+        endpoint, path_args = found
+        if path_args is not None:
+            # callers get their own copy of the cached path args
+            path_args = dict(path_args)
+        return endpoint, path_args
+
 
     def _add_args(self, req):
         args = req.QUERY_STRING.split('=')
@@ -375,6 +1135,7 @@ class ServicePublisher(object):
             We expect environ to be a valid wgsi python dictionary.
         '''
         req = WSGIRequest(environ)
+        req.spool_threshold = self._spool_threshold
 
 #        if isinstance(environ, types.DictType):
 #            req = WSGIRequest(environ)
@@ -389,48 +1150,49 @@ class ServicePublisher(object):
         final_content = ""
         endpoint = None
         try:
-            # allow '_method' query arg to override method
+            # allow '_method' query arg to override method, only the query
+            # string is looked at so nothing gets parsed before routing
             method = req.method
-            if '_method' in req.arguments:
-                method = req.arguments['_method'][0].upper()
-                del req.arguments['_method']
+            query = environ.get('QUERY_STRING')
+            if query and '_method' in query:
+                override = parse_query_string(query).get(u'_method')
+                if override:
+                    method = override[0].upper()
 
             # find appropriate endpoint
-            reqline = method + urllib.unquote(req.path)
-            match = None
-            for endpoint in self._endpoints:
-                match = endpoint.match(reqline)
-                if match:
-                    break
-
-            if not match:
+            router = self._router
+            if self._hosts or self._wildcard_hosts:
+                router = self._host_router(environ)
+            endpoint, path_args = self._find_endpoint(
+                router, method, req.path)
+
+            if not endpoint:
                 if self._fallbackapp:
                     _log.debug("Using fallback app for request: (%s) (%s)" % \
                                (method, req.uri))
-                    # Since recreating a stringio from the request body can be
-                    # expensive, we only want to do this if we fallback.
-                    environ['wsgi.input'] = StringIO.StringIO(req.body)
+                    # Untouched input goes to the fallback app as is and
+                    # streams, only hand over our (rewound) copy if the body
+                    # has already been read.
+                    if req.body_read():
+                        environ['wsgi.input'] = req.body_file
+                        self._fallback_rewound += 1
+                    else:
+                        self._fallback_passthrough += 1
                     return self._fallbackapp(environ, start_response)
+                elif self._options.method_not_allowed and \
+                        not router.allows(method):
+                    raise HTTPException(405)
                 else:
                     raise HTTPException(404)
 
-            # convert all values in req.arguments from lists to scalars,
-            # then combine with path args.
-            arguments = dict((k, v[0]) for k, v in req.arguments.iteritems()\
-                if isinstance(v, list) and len(v) > 0)
-            inargs = dict(match.groupdict(), **arguments)
-
-            # compile positional arguments
-            args = []
-            for arg in endpoint.sequential:
-                args.append(arg.argspec(req, inargs))
+            # refuse oversized bodies before anything reads them, nothing
+            # has up to here
+            req.max_body_size = endpoint.max_body_size or \
+                self._options.max_body_size
+            req.check_body_size()
 
-            # compile keyword arguments
-            kwargs = {}
-            for argname, arg in endpoint.named.iteritems():
-                r = arg.argspec(req, inargs)
-                if r != None:
-                    kwargs[argname] = r
+            # positional and keyword arguments
+            args, kwargs = endpoint.bind(req, path_args)
 
             # invoke the service endpoint
             result = endpoint(*args, **kwargs)
@@ -441,6 +1203,10 @@ class ServicePublisher(object):
                 _log.debug(_gen_trace_str(
                     endpoint.function, args, kwargs, result))
 
+            if req._buffer is not None and \
+                    not isinstance(endpoint.renderer, Written):
+                raise ValueError("endpoint %s wrote to the request, it "
+                    "needs the Written renderer" % endpoint.name)
             if isinstance(endpoint.renderer, RequestAwareRenderer):
                 r = endpoint.renderer(req, result)
             else:
@@ -449,6 +1215,8 @@ class ServicePublisher(object):
                 r.content, r.content_type, r.http_status, r.headers
 
         except (Exception), e:
+            # nothing the endpoint wrote goes out with an error
+            req._buffer = None
             error_response = None
             logged_trace = False
             #
@@ -495,7 +1263,14 @@ class ServicePublisher(object):
             content,
             extra_headers
         )
-
+        written = req._buffer
+        # spooled bodies and uploads are done with
+        req.close()
+
+        if written is not None:
+            # the Written renderer's body, sent as the chunks it was written
+            # in
+            return written
         return [final_content + "\r\n"]
 
 def _finish_request(req, start_response, code, content_type, content, headers):
@@ -515,6 +1290,8 @@ def _finish_request(req, start_response, code, content_type, content, headers):
 
     except (Exception), e:
         _log.exception(e)
+        # the error replaces anything the endpoint wrote too
+        req._buffer = None
         final_headers = [('Content-Type', DEFAULT_ERROR_CONTENT_TYPE)]
         content = DEFAULT_ERROR_CONTENT
         code = DEFAULT_ERROR_CODE
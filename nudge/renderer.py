@@ -36,6 +36,7 @@ __all__ = [
     'Ical',
     'Identity',
     'Plain',
+    'Written',
 ]
 
 class Result(object):
@@ -257,3 +258,19 @@ class Identity(object):
         return Result(content, self.content_type, self.http_status,
             self.headers)
 
+class Written(RequestAwareRenderer):
+    """ For endpoints that send their body with req.write(). What they wrote
+        is the whole body, they must return None. Endpoints with any other
+        renderer can't write. """
+    def __init__(self, content_type, http_status=200, headers=None):
+        self.content_type = content_type
+        self.http_status = http_status
+        if not headers:
+            headers = {}
+        self.headers = headers
+
+    def __call__(self, req, result):
+        if result is not None:
+            raise ValueError(
+                "endpoints with the Written renderer must return None")
+        return Result('', self.content_type, self.http_status, self.headers)
@@ -0,0 +1,925 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import bisect
+import heapq
+import re
+import sre_constants
+import sre_parse
+import warnings
+
+from nudge.error import HTTPException
+
+__all__ = [
+    'Router',
+    'redos_risk',
+    'REDOS_EXPONENTIAL',
+    'REDOS_POLYNOMIAL',
+]
+
+""" Compiled endpoint dispatch.
+
+    Endpoint uris are arbitrary regexes matched against method + path. Most
+    of them are really a handful of literal path segments with the odd
+    capture, so the Router splits each pattern on '/' and files it into a
+    per-method tree of path segments. Literal segments are a dict lookup,
+    only segments that really need a regex get one, and patterns that can't
+    be split safely (anything able to match across a '/') are kept as plain
+    regexes. Every route remembers its registration order, so the first
+    registered route that matches always wins, exactly like the old linear
+    scan over ServicePublisher._endpoints.
+
+    The routes left as regexes are folded into alternation regexes, one
+    named marker group per route, so a single re.match finds the first
+    matching route among them.
+
+    Patterns with no regex at all (and a trailing '$') never reach either:
+    they are answered from a {method: {path: route}} table.
+
+    With a reorder_interval the regex routes count their matches and every
+    reorder_interval regex dispatches the hottest ones are moved to the
+    front. Two routes are only ever swapped when their literal prefixes
+    rule out a common match, so the first match is still the first
+    registered one.
+
+    Every pattern is also checked for catastrophic backtracking when it is
+    added, see redos_risk. Risky patterns are always matched as regexes,
+    and only against request lines up to max_risky_length long.
+"""
+
+REDOS_EXPONENTIAL = 'exponential'
+REDOS_POLYNOMIAL = 'polynomial'
+
+
+_SLASH = ord('/')
+_UNSET = object()
+_METHOD_RE = re.compile(r'^[A-Za-z_-]+$')
+_GROUP_NAME_RE = re.compile(r'(?<!\\)\(\?P<([A-Za-z_]\w*)>')
+# sre in python 2 refuses patterns with 100 or more capturing groups
+_MAX_GROUPS = 99
+
+
+class _Route(object):
+    __slots__ = ('index', 'endpoint', 'regex', 'prefix', 'after', 'hits',
+                 'risk', 'branch')
+
+    def __init__(self, index, endpoint, regex, risk=None):
+        self.index = index
+        self.endpoint = endpoint
+        self.regex = regex
+        self.risk = risk
+        self.prefix = None
+        # earlier regex routes that may match the same request line
+        self.after = ()
+        self.hits = 0
+        # _branch's result, worked out once since reorders rebuild blocks
+        self.branch = _UNSET
+
+
+class _Block(object):
+    """ A run of consecutive regex routes compiled into one alternation.
+        branches maps each marker group name to (route, [(name, group)]).
+        Routes that can't be combined get a block of their own with no
+        branches. The alternation is only compiled once a request gets
+        to it. """
+    __slots__ = ('lowest', 'regex', 'source', 'route', 'branches', 'risky')
+
+    def __init__(self, route, source=None, branches=None):
+        self.route = route
+        self.source = source
+        self.regex = source is None and route.regex or None
+        self.branches = branches
+        if branches:
+            routes = [r for r, names in branches.values()]
+        else:
+            routes = [route]
+        self.lowest = min([r.index for r in routes])
+        self.risky = bool([r for r in routes if r.risk])
+
+
+class _Node(object):
+    """ One path segment in the routing tree. """
+    __slots__ = ('literals', 'patterns', 'route', 'prefixes', 'lowest')
+
+    def __init__(self):
+        self.literals = {}
+        # [(segment source, compiled segment regex, child node)]
+        self.patterns = []
+        # route ending exactly at this node
+        self.route = None
+        # [(literal, route)] for patterns without a trailing '$'
+        self.prefixes = []
+        # lowest route index anywhere at or below this node, for pruning
+        self.lowest = None
+
+    def _seen(self, route):
+        if self.lowest is None or route.index < self.lowest:
+            self.lowest = route.index
+
+
+class Router(object):
+    """ First-match-wins dispatch over a list of Endpoints.
+
+        >>> router = Router()
+        >>> router.add(endpoint)
+        >>> endpoint, path_args = router.match('GET', '/users/12')
+
+        With safe=True, add() refuses patterns that can backtrack
+        exponentially instead of just warning about them.
+    """
+
+    def __init__(self, reorder_interval=0, max_risky_length=2048,
+                 safe=False):
+        self.reorder_interval = reorder_interval
+        self.max_risky_length = max_risky_length
+        self.safe = safe
+        self._routes = []
+        self._trees = {}
+        self._regex_routes = []
+        self._blocks = None
+        self._regex_dispatches = 0
+        # regex route literal prefixes, as {prefix: [route]} and sorted
+        self._by_prefix = {}
+        self._sorted_prefixes = []
+        # {method: {path: (route, path_args)}} for patterns without regex,
+        # every entry is complete before match() can see it
+        self._static = {}
+        self._methods = set()
+        self._any_method = False
+
+    def add(self, endpoint):
+        risks = []
+        for regex in endpoint.regexs:
+            risk, reason = redos_risk(regex.pattern)
+            if risk == REDOS_EXPONENTIAL:
+                msg = "Endpoint %s uri %r can backtrack catastrophically: %s" %\
+                    (endpoint.name, regex.pattern, reason)
+                if self.safe:
+                    raise ValueError(msg)
+                warnings.warn(msg)
+            risks.append(risk)
+
+        if _METHOD_RE.match(endpoint.method):
+            self._methods.add(endpoint.method)
+        else:
+            self._any_method = True
+        for uri, regex, risk in zip(endpoint.uris, endpoint.regexs, risks):
+            route = _Route(len(self._routes), endpoint, regex, risk)
+            self._routes.append(route)
+            segments = None
+            if not risk:
+                segments = _split_pattern(endpoint.method, uri, regex)
+            if segments is None:
+                self._add_regex_route(route)
+            elif _is_static(segments):
+                self._add_static_route(route, segments)
+            else:
+                self._insert(endpoint.method, segments, route)
+
+    def allows(self, method):
+        """ False if no registered route can ever match this method """
+        return self._any_method or method in self._methods
+
+    def match(self, method, path):
+        """ Returns (endpoint, path_args) for the first registered route
+            matching this method and (unquoted) path, or (None, None). """
+        static = self._static.get(method)
+        if static is not None:
+            found = static.get(path)
+            if found is not None:
+                return found[0].endpoint, dict(found[1])
+        elif not self._any_method and method not in self._methods:
+            return None, None
+        route, path_args = self._resolve(method, path)
+        if route is None:
+            return None, None
+        return route.endpoint, path_args
+
+    def _resolve(self, method, path):
+        """ Returns (route, path_args) for the first matching dynamic route """
+        reqline = method + path
+        too_long = self.max_risky_length and \
+            len(reqline) > self.max_risky_length
+        if '\n' in path:
+            # '$' also matches before a trailing newline, leave these odd
+            # paths to the real regexes.
+            return self._scan(self._routes, reqline, too_long)
+
+        best = None
+        tree = self._trees.get(method)
+        if tree is not None and path.startswith('/'):
+            best = _search(tree, path[1:].split('/'), 0, [], None)
+
+        blocks = self._blocks
+        if blocks is None:
+            blocks = self._blocks = _compile_blocks(self._regex_routes)
+        limit = best and best[0].index
+        # lowest index among the risky routes skipped for a long reqline
+        skipped = None
+        for block in blocks:
+            if best and block.lowest > limit:
+                continue
+            if too_long and block.risky:
+                if skipped is None or block.lowest < skipped:
+                    skipped = block.lowest
+                continue
+            regex = block.regex
+            if regex is None:
+                regex = block.regex = re.compile(block.source)
+            match = regex.match(reqline)
+            if not match:
+                continue
+            # Overlapping routes never change order, so this is the lowest
+            # indexed regex route that matches.
+            if block.branches is None:
+                route = block.route
+                path_args = match.groupdict()
+            else:
+                route, names = block.branches[match.lastgroup]
+                path_args = dict(
+                    [(name, match.group(group)) for name, group in names])
+            if best and route.index > limit:
+                break
+            if skipped is not None and skipped < route.index:
+                raise HTTPException(414)
+            self._hit(route)
+            return route, path_args
+
+        if skipped is not None and (not best or skipped < best[0].index):
+            # one of the skipped routes might have been the first match
+            raise HTTPException(414)
+        if best:
+            route, captured = best
+            path_args = {}
+            for groups in captured:
+                path_args.update(groups)
+            return route, path_args
+        return None, None
+
+    def _add_regex_route(self, route):
+        prefix = route.prefix = _literal_prefix(route.regex)
+        after = {}
+        for i in xrange(len(prefix) + 1):
+            for other in self._by_prefix.get(prefix[:i], ()):
+                after[other.index] = other
+        sorted_prefixes = self._sorted_prefixes
+        i = bisect.bisect_left(sorted_prefixes, (prefix, -1))
+        while i < len(sorted_prefixes) and \
+                sorted_prefixes[i][0].startswith(prefix):
+            other = self._routes[sorted_prefixes[i][1]]
+            after[other.index] = other
+            i += 1
+        route.after = after.values()
+        self._by_prefix.setdefault(prefix, []).append(route)
+        bisect.insort(sorted_prefixes, (prefix, route.index))
+        self._regex_routes.append(route)
+        self._blocks = None
+
+    def _hit(self, route):
+        route.hits += 1
+        self._regex_dispatches += 1
+        if self.reorder_interval and \
+                self._regex_dispatches >= self.reorder_interval:
+            self._regex_dispatches = 0
+            self.reorder()
+
+    def reorder(self):
+        """ Try the most matched regex routes first, as far as the
+            routes they might overlap with allow. """
+        routes = self._regex_routes
+        waiting = {}
+        unblocks = {}
+        ready = []
+        for route in routes:
+            waiting[route.index] = len(route.after)
+            for other in route.after:
+                unblocks.setdefault(other.index, []).append(route)
+            if not route.after:
+                ready.append((-route.hits, route.index, route))
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            route = heapq.heappop(ready)[2]
+            ordered.append(route)
+            for other in unblocks.get(route.index, ()):
+                waiting[other.index] -= 1
+                if not waiting[other.index]:
+                    heapq.heappush(ready, (-other.hits, other.index, other))
+        for route in routes:
+            # let old traffic fade so the order can follow new traffic
+            route.hits //= 2
+        if ordered != routes:
+            self._regex_routes = ordered
+            self._blocks = None
+
+    def _scan(self, routes, reqline, too_long=False):
+        for route in routes:
+            if too_long and route.risk:
+                raise HTTPException(414)
+            match = route.regex.match(reqline)
+            if match:
+                return route, match.groupdict()
+        return None, None
+
+    def _add_static_route(self, route, segments):
+        """ Static routes only ever match their own path, so the winner for
+            that path is worked out here: the static route itself unless an
+            earlier route matches the same path. Later routes never win. """
+        pieces, anchored, optional_slash = segments
+        method = route.endpoint.method
+        table = self._static.get(method) or {}
+        path = '/' + '/'.join([source for source, compiled in pieces])
+        paths = [path]
+        if optional_slash:
+            paths.append(path + '/')
+        for path in paths:
+            if path in table:
+                # an earlier static route already owns this path
+                continue
+            found = self._earlier_match(method, path, route.index)
+            if found[0] is None:
+                found = route, {}
+            table[path] = found
+        self._static[method] = table
+
+    def _earlier_match(self, method, path, before):
+        """ The first route below index before matching this path, without
+            counting it as a hit the way _resolve does """
+        best = None
+        tree = self._trees.get(method)
+        if tree is not None:
+            best = _search(tree, path[1:].split('/'), 0, [], None)
+            if best and best[0].index > before:
+                best = None
+        if best:
+            limit = best[0].index
+            path_args = {}
+            for groups in best[1]:
+                path_args.update(groups)
+            best = best[0], path_args
+        else:
+            limit = before
+            best = None, None
+        reqline = method + path
+        for route in self._regex_routes:
+            if route.index < limit:
+                match = route.regex.match(reqline)
+                if match:
+                    limit = route.index
+                    best = route, match.groupdict()
+        return best
+
+    def _insert(self, method, segments, route):
+        pieces, anchored, optional_slash = segments
+        node = self._trees.setdefault(method, _Node())
+        node._seen(route)
+        last = len(pieces) - 1
+        for i, (source, compiled) in enumerate(pieces):
+            if i == last and not anchored:
+                node.prefixes.append((source, route))
+                return
+            if compiled is None:
+                child = node.literals.get(source)
+                if child is None:
+                    child = node.literals[source] = _Node()
+            else:
+                for src, regex, child in node.patterns:
+                    if src == source:
+                        break
+                else:
+                    child = _Node()
+                    node.patterns.append((source, compiled, child))
+            node = child
+            node._seen(route)
+        if node.route is None:
+            node.route = route
+        if optional_slash:
+            child = node.literals.get('')
+            if child is None:
+                child = node.literals[''] = _Node()
+            child._seen(route)
+            if child.route is None:
+                child.route = route
+
+
+def _search(node, segments, depth, captured, best):
+    """ Depth first walk returning the lowest indexed (route, captures) """
+    if best and node.lowest > best[0].index:
+        return best
+    if depth == len(segments):
+        route = node.route
+        if route and (not best or route.index < best[0].index):
+            best = route, list(captured)
+        return best
+
+    segment = segments[depth]
+    for literal, route in node.prefixes:
+        if segment.startswith(literal) and \
+                (not best or route.index < best[0].index):
+            best = route, list(captured)
+    child = node.literals.get(segment)
+    if child is not None:
+        best = _search(child, segments, depth + 1, captured, best)
+    for source, regex, child in node.patterns:
+        match = regex.match(segment)
+        if match:
+            captured.append(match.groupdict())
+            best = _search(child, segments, depth + 1, captured, best)
+            captured.pop()
+    return best
+
+
+def _compile_blocks(routes):
+    """ Fold consecutive regex routes into as few alternations as sre
+        allows, keeping registration order between and within blocks. """
+    blocks = []
+    pending = []
+    groups = 0
+
+    def flush():
+        if len(pending) == 1:
+            blocks.append(_Block(pending[0][1]))
+        elif pending:
+            source = '|'.join([branch for branch, route, names in pending])
+            branches = {}
+            for branch, route, names in pending:
+                branches['_r%d' % route.index] = (route, names)
+            blocks.append(_Block(pending[0][1], source, branches))
+        del pending[:]
+
+    for route in routes:
+        branch = _branch(route)
+        if branch is None:
+            flush()
+            groups = 0
+            blocks.append(_Block(route))
+            continue
+        if groups + route.regex.groups + 1 > _MAX_GROUPS:
+            flush()
+            groups = 0
+        pending.append(branch)
+        groups += route.regex.groups + 1
+    flush()
+    return blocks
+
+
+def _branch(route):
+    """ Returns (source, route, [(name, group)]) with the route's named
+        groups prefixed so they can't collide with other routes, or None if
+        the pattern can't share a regex (inline flags, back references,
+        too many groups) or is risky enough to be skipped on its own. """
+    if route.branch is _UNSET:
+        route.branch = _make_branch(route)
+    return route.branch
+
+
+def _make_branch(route):
+    regex = route.regex
+    if route.risk or regex.flags & ~re.UNICODE or regex.groups + 1 > _MAX_GROUPS or \
+            _has_groupref(regex.pattern):
+        return None
+    prefix = '_r%d_' % route.index
+    renamed = _GROUP_NAME_RE.sub(
+        lambda m: '(?P<%s%s>' % (prefix, m.group(1)),
+        regex.pattern
+    )
+    try:
+        check = re.compile(renamed)
+    except (re.error, AssertionError):
+        return None
+    expected = dict([(prefix + name, index)
+                     for name, index in regex.groupindex.items()])
+    if check.groupindex != expected or check.groups != regex.groups:
+        return None
+    names = [(name, prefix + name) for name in regex.groupindex]
+    return '(?P<_r%d>%s)' % (route.index, renamed), route, names
+
+
+def _has_groupref(pattern):
+    try:
+        return _walk_groupref(sre_parse.parse(pattern))
+    except (sre_constants.error, AssertionError):
+        return True
+
+
+def _walk_groupref(items):
+    for op, av in items:
+        if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return True
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if _walk_groupref(av[2]):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _walk_groupref(av[-1]):
+                return True
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                if _walk_groupref(branch):
+                    return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _walk_groupref(av[1]):
+                return True
+    return False
+
+
+def redos_risk(pattern):
+    """ Static check of a regex source for catastrophic backtracking.
+
+        Returns (risk, reason). risk is None when no problem was found,
+        REDOS_POLYNOMIAL when two unbounded repeats can trade characters
+        between them (eg. '.*x.*', quadratic on a failed match) and
+        REDOS_EXPONENTIAL for nested quantifiers ('(a+)+', '(\w+\s?)*')
+        or repeated alternatives that overlap ('(a|aa)*').
+
+        This is a heuristic, a pattern without risk is not guaranteed to
+        run in linear time.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, AssertionError):
+        return None, None
+    icase = parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE
+    return _analyze(list(parsed), icase)
+
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_ALL = frozenset(range(256))
+_DIGIT = frozenset(map(ord, '0123456789'))
+_SPACE = frozenset(map(ord, ' \t\n\r\f\v'))
+_WORD = frozenset([c for c in range(256) if chr(c).isalnum() and c < 128] +
+                  [ord('_')])
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: _DIGIT,
+    sre_constants.CATEGORY_NOT_DIGIT: _ALL - _DIGIT,
+    sre_constants.CATEGORY_SPACE: _SPACE,
+    sre_constants.CATEGORY_NOT_SPACE: _ALL - _SPACE,
+    sre_constants.CATEGORY_WORD: _WORD,
+    sre_constants.CATEGORY_NOT_WORD: _ALL - _WORD,
+}
+
+
+def _analyze(items, icase):
+    worst = None, None
+    seq = _flatten(items)
+    # unbounded repeats that a later repeat could still steal from
+    open_sets = []
+    for op, av in seq:
+        found = None, None
+        if op in _REPEATS:
+            min_, max_, body = av
+            body_set = _single_char_set(body, icase)
+            if max_ > 1 and body_set is None:
+                reason = _nested_risk(body, icase)
+                if reason:
+                    return REDOS_EXPONENTIAL, reason
+            found = _analyze(body, icase)
+            if max_ == sre_constants.MAXREPEAT:
+                repeat_set = body_set
+                if repeat_set is None:
+                    repeat_set = frozenset(_chars_in(body, icase))
+                for other in open_sets:
+                    if other & repeat_set:
+                        found = REDOS_POLYNOMIAL, \
+                            "adjacent unbounded repeats overlap"
+                        break
+                if min_ >= 1:
+                    open_sets = [o for o in open_sets if o & repeat_set]
+                open_sets.append(repeat_set)
+            elif min_ >= 1 and body_set is not None:
+                open_sets = [o for o in open_sets if o & body_set]
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                found = _worse(found, _analyze(branch, icase))
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            found = _analyze(av[1], icase)
+        else:
+            char_set = _char_set(op, av, icase)
+            if char_set is not None:
+                open_sets = [o for o in open_sets if o & char_set]
+        if found[0] == REDOS_EXPONENTIAL:
+            return found
+        worst = _worse(worst, found)
+    return worst
+
+
+def _worse(a, b):
+    if b[0] == REDOS_EXPONENTIAL or a[0] is None:
+        return b
+    return a
+
+
+def _nested_risk(body, icase):
+    """ Why the body of a repeat can match one string in many ways """
+    seq = _flatten(body)
+    for i, (op, av) in enumerate(seq):
+        variable = None
+        if op in _REPEATS:
+            if av[0] != av[1]:
+                variable = av[2]
+        elif op == sre_constants.BRANCH:
+            # sre_parse factors out common prefixes, '(?:a|a)' is 'a'
+            # followed by two empty alternatives. Two alternatives that
+            # can both match nothing match the same string.
+            nullable = [branch for branch in av[1]
+                        if branch.getwidth()[0] == 0]
+            if len(nullable) > 1:
+                return "repeated alternatives overlap"
+            firsts = [_first_set(branch, icase) for branch in av[1]]
+            for j in range(len(firsts)):
+                for k in range(j + 1, len(firsts)):
+                    if firsts[j] & firsts[k]:
+                        return "repeated alternatives overlap"
+            if len(set([branch.getwidth() for branch in av[1]])) > 1:
+                variable = [(op, av)]
+        # A variable width item followed, possibly in the next iteration,
+        # by characters it could also have eaten.
+        if variable is not None:
+            chars = _chars_in(variable, icase)
+            if not _fenced(seq[i + 1:] + seq[:i], chars, icase):
+                return "nested quantifier"
+    return None
+
+
+def _fenced(seq, char_set, icase):
+    """ True if seq has a required character that char_set can't match """
+    for op, av in seq:
+        if op in _REPEATS:
+            if av[0] < 1:
+                continue
+            fence = _single_char_set(av[2], icase)
+        else:
+            fence = _char_set(op, av, icase)
+        if fence is not None and not fence & char_set:
+            return True
+    return False
+
+
+def _first_set(items, icase):
+    """ Characters a match of items can start with """
+    first = set()
+    for op, av in _flatten(items):
+        char_set = _char_set(op, av, icase)
+        if char_set is not None:
+            return first | char_set
+        if op in _REPEATS:
+            first |= _first_set(av[2], icase)
+            if av[0] >= 1:
+                return first
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                first |= _first_set(branch, icase)
+            return first
+        elif op != sre_constants.AT:
+            return _ALL
+    return first
+
+
+def _chars_in(items, icase):
+    """ Every character items could match """
+    chars = set()
+    for op, av in _flatten(items):
+        char_set = _char_set(op, av, icase)
+        if char_set is not None:
+            chars |= char_set
+        elif op in _REPEATS:
+            chars |= _chars_in(av[2], icase)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                chars |= _chars_in(branch, icase)
+        elif op != sre_constants.AT:
+            return _ALL
+    return chars
+
+
+def _flatten(items):
+    """ Inline group contents, groups don't change what can match """
+    flat = []
+    for op, av in items:
+        if op == sre_constants.SUBPATTERN:
+            flat.extend(_flatten(av[-1]))
+        else:
+            flat.append((op, av))
+    return flat
+
+
+def _single_char_set(items, icase):
+    items = _flatten(items)
+    if len(items) == 1:
+        return _char_set(items[0][0], items[0][1], icase)
+    return None
+
+
+def _char_set(op, av, icase):
+    """ The bytes a single character item matches, None for anything else """
+    if op == sre_constants.LITERAL:
+        chars = frozenset([av])
+    elif op == sre_constants.NOT_LITERAL:
+        chars = _ALL - frozenset([av])
+    elif op == sre_constants.ANY:
+        chars = _ALL - frozenset([ord('\n')])
+    elif op == sre_constants.IN:
+        chars = set()
+        negate = False
+        for in_op, in_av in av:
+            if in_op == sre_constants.NEGATE:
+                negate = True
+            elif in_op == sre_constants.LITERAL:
+                chars.add(in_av)
+            elif in_op == sre_constants.RANGE:
+                chars.update(range(in_av[0], min(in_av[1], 255) + 1))
+            elif in_op == sre_constants.CATEGORY:
+                chars |= _CATEGORIES.get(in_av, _ALL)
+            else:
+                chars = set(_ALL)
+        chars = frozenset(chars)
+        if negate:
+            chars = _ALL - chars
+    else:
+        return None
+    if icase:
+        chars = chars | frozenset(
+            [ord(chr(c).swapcase()) for c in chars if c < 128])
+    return chars
+
+
+def _literal_prefix(regex):
+    """ The literal text every match of this regex has to start with """
+    if regex.flags & re.IGNORECASE:
+        return ''
+    try:
+        items = sre_parse.parse(regex.pattern)
+    except (sre_constants.error, AssertionError):
+        return ''
+    prefix = []
+    for op, av in items:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(chr(av))
+    return ''.join(prefix)
+
+
+def _is_static(segments):
+    pieces, anchored, optional_slash = segments
+    if not anchored:
+        return False
+    for source, compiled in pieces:
+        if compiled is not None:
+            return False
+    return True
+
+
+def _split_pattern(method, uri, regex):
+    """ Break a uri pattern into per segment pieces.
+
+        Returns ([(source, compiled or None for literals)], anchored,
+        optional_slash) or None when the pattern has to stay a regex.
+    """
+    if not _METHOD_RE.match(method) or regex.flags & ~re.UNICODE:
+        return None
+    anchored = optional_slash = False
+    if uri.endswith('/?$') and not uri.endswith('\\/?$'):
+        uri = uri[:-3]
+        anchored = optional_slash = True
+    elif uri.endswith('$') and not uri.endswith('\\$'):
+        uri = uri[:-1]
+        anchored = True
+    sources = _split_segments(uri)
+    if not sources or sources[0] != '':
+        return None
+    pieces = []
+    for source in sources[1:]:
+        try:
+            parsed = sre_parse.parse(source)
+        except (sre_constants.error, AssertionError):
+            return None
+        items = list(parsed)
+        if all(op == sre_constants.LITERAL for op, av in items):
+            literal = ''.join([chr(av) for op, av in items])
+            if '/' in literal:
+                return None
+            pieces.append((literal, None))
+        elif _confined(items):
+            pieces.append((source, re.compile('(?:%s)\Z' % source)))
+        else:
+            return None
+    if not pieces:
+        return None
+    if not anchored and pieces[-1][1] is not None:
+        # An unanchored regex segment can stop anywhere inside the segment
+        return None
+    return pieces, anchored, optional_slash
+
+
+def _split_segments(pattern):
+    """ Split a regex source on the top level '/' characters. Returns None
+        if the pattern is unbalanced, quantifies a '/' or has a top level
+        '|' (its alternatives span segments). """
+    segments = []
+    current = []
+    depth = 0
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            current.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if c == '[':
+            end = i + 1
+            if end < n and pattern[end] == '^':
+                end += 1
+            if end < n and pattern[end] == ']':
+                end += 1
+            while end < n and pattern[end] != ']':
+                if pattern[end] == '\\':
+                    end += 1
+                end += 1
+            current.append(pattern[i:end + 1])
+            i = end + 1
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif c == '|' and depth == 0:
+            return None
+        if c == '/' and depth == 0:
+            if i + 1 < n and pattern[i + 1] in '?*+{':
+                return None
+            segments.append(''.join(current))
+            current = []
+        else:
+            current.append(c)
+        i += 1
+    if depth:
+        return None
+    segments.append(''.join(current))
+    return segments
+
+
+def _confined(items):
+    """ True if the parsed regex items can never match a '/' """
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            if av == _SLASH:
+                return False
+        elif op == sre_constants.NOT_LITERAL:
+            if av != _SLASH:
+                return False
+        elif op == sre_constants.IN:
+            if _in_matches_slash(av):
+                return False
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if not _confined(av[2]):
+                return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _confined(av[-1]):
+                return False
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                if not _confined(branch):
+                    return False
+        else:
+            # ANY, anchors, lookarounds, backreferences...
+            return False
+    return True
+
+
+def _in_matches_slash(items):
+    negate = False
+    found = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            found = found or av == _SLASH
+        elif op == sre_constants.RANGE:
+            found = found or av[0] <= _SLASH <= av[1]
+        elif op == sre_constants.CATEGORY:
+            # '/' is not a digit, space or word character
+            found = found or av in (
+                sre_constants.CATEGORY_NOT_DIGIT,
+                sre_constants.CATEGORY_NOT_SPACE,
+                sre_constants.CATEGORY_NOT_WORD,
+            )
+        else:
+            return True
+    return found != negate
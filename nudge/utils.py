@@ -1,4 +1,5 @@
 import re
+import threading
 
 '''
     I'm a first class citizen dictionary.
@@ -67,3 +68,116 @@ def breakup_path(input, camel_case=True):
     if package:
         garbage, dot, package = package.rpartition('.')
     return package, class_name, function_name
+
+
+'''
+    Bounded mapping that forgets the least recently used key once it holds
+    size entries. Keeps hit/miss counts so callers can tell if it helps.
+
+        cache = LRUCache(256)
+        value = cache.get(key, missing)
+        if value is missing:
+            value = cache[key] = compute(key)
+'''
+class LRUCache(object):
+
+    def __init__(self, size=128):
+        assert isinstance(size, int) and size > 0, \
+            "LRUCache size must be a positive int"
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._map = {}
+        self._lock = threading.Lock()
+        # circular doubly linked list of [prev, next, key, value], the root
+        # sits between the most and least recently used links.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            prev, next_ = link[0], link[1]
+            prev[1] = next_
+            next_[0] = prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                link[3] = value
+                return
+            root = self._root
+            if len(self._map) >= self.size:
+                # drop the least recently used link
+                oldest = root[1]
+                del self._map[oldest[2]]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+            last = root[0]
+            link = [last, root, key, value]
+            last[1] = root[0] = self._map[key] = link
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': self.size,
+            'entries': len(self._map),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+        }
+
+
+def iter_lines(stream, chunk_size=64 * 1024, max_line_size=1024 * 1024):
+    ''' Yields the lines read from stream, line endings included, reading
+        chunk_size bytes at a time. Raises ValueError for lines longer than
+        max_line_size. '''
+    buf = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buf += chunk
+        start = 0
+        end = buf.find('\n')
+        while end >= 0:
+            yield buf[start:end + 1]
+            start = end + 1
+            end = buf.find('\n', start)
+        buf = buf[start:]
+        if len(buf) > max_line_size:
+            raise ValueError("line over %d bytes" % max_line_size)
+    if buf:
+        yield buf
@@ -16,12 +16,14 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
+import array
 import re
 import functools
 import types
 
 import nudge.json
 import datetime
+from nudge.utils import LRUCache
 
 __all__ = [
     'ValidationError',
@@ -35,13 +37,77 @@ __all__ = [
     'Boolean',
     'Json',
     'List',
+    'IntegerList',
     'Dict',
+    'Schema',
+    'ListOf',
+    'Optional',
+    'Memoize',
 ]
 
 class ValidationError(BaseException):
     def __init__(self, message=None):
         self.message = message
 
+def pure(factory):
+    """ Marks the validators a factory makes as pure, their result depends
+        only on the input, so Memoize may wrap them. """
+    @functools.wraps(factory)
+    def make(*args, **kwargs):
+        f = factory(*args, **kwargs)
+        f.pure = True
+        return f
+    return make
+
+MEMO_SIZE = 256
+MEMO_MAX_LEN = 256
+# results of these types can be shared between requests, anything else
+# (eg. the dicts Json returns) is recomputed every time
+_immutable = (types.NoneType, bool, int, long, float, str, unicode,
+              datetime.date, datetime.datetime, datetime.time)
+
+def Memoize(validator, size=MEMO_SIZE, max_len=MEMO_MAX_LEN):
+    """ Caches a pure validator in a bounded LRU keyed by the input string.
+        Both ValidationErrors and immutable results are cached, inputs
+        longer than max_len and mutable results are not. The returned
+        function has stats() with the cache hit rate. """
+    assert getattr(validator, 'pure', False), \
+        "only pure validators can be memoized"
+    assert isinstance(max_len, int) and max_len > 0, \
+        "max_len must be a positive int"
+    cache = LRUCache(size)
+    uncached = [0]
+    def f(s):
+        if type(s) not in (str, unicode) or len(s) > max_len:
+            uncached[0] += 1
+            return validator(s)
+        # u'1' == '1', but a validator may hand either back
+        key = (type(s), s)
+        hit = cache.get(key)
+        if hit is not None:
+            if hit[0]:
+                return hit[1]
+            raise hit[1]
+        try:
+            v = validator(s)
+        except (ValidationError), e:
+            cache[key] = (False, e)
+            raise
+        if isinstance(v, _immutable):
+            cache[key] = (True, v)
+        else:
+            uncached[0] += 1
+        return v
+    def stats():
+        stats = cache.stats()
+        stats['uncached'] = uncached[0]
+        return stats
+    f.pure = True
+    f.cache = cache
+    f.stats = stats
+    return f
+
+@pure
 def DateTime():
     date_re = re.compile(r'^\d{8}T\d{6}')
     def f(s):
@@ -51,6 +117,7 @@ def DateTime():
         return s
     return f
 
+@pure
 def Date():
     """convert a string (eg. '20100527' to a datetime.date"""
 
@@ -80,6 +147,7 @@ def NotEmpty():
         return s
     return f
 
+@pure
 def Int(min_=None, max_=None):
     def f(s):
         try:
@@ -105,6 +173,56 @@ def List(min_=None, max_=None):
         return s
     return f
 
+def IntegerList(min_=None, max_=None, max_count=None, use_numpy=False):
+    """ Integers given as repeated values, comma separated ones or both
+        (eg. ['1,2', '3'] from ?id=1,2&id=3), or a JSON list of ints. They
+        are parsed in bulk into an array.array('l'), or with use_numpy a
+        numpy array sharing its memory if numpy can be imported. """
+    numpy = None
+    if use_numpy:
+        try:
+            import numpy
+        except ImportError:
+            pass
+    def f(s):
+        if isinstance(s, basestring):
+            s = [s]
+        elif not isinstance(s, list):
+            raise ValidationError("must be a list of integers")
+        if s and isinstance(s[0], basestring):
+            try:
+                s = ','.join(s)
+            except (TypeError):
+                raise ValidationError("must be a list of integers")
+            # refuse oversized lists before parsing any of them
+            if max_count is not None and s.count(',') >= max_count:
+                raise ValidationError(
+                    "must have at most %i integers" % max_count)
+            s = s.split(',')
+        else:
+            if max_count is not None and len(s) > max_count:
+                raise ValidationError(
+                    "must have at most %i integers" % max_count)
+            for i in s:
+                if type(i) not in (int, long):
+                    raise ValidationError("must be a list of integers")
+        try:
+            ints = array.array('l', map(int, s))
+        except (ValueError, TypeError):
+            raise ValidationError("must be a comma separated list of integers")
+        except (OverflowError):
+            raise ValidationError("integer out of range")
+        if ints:
+            if min_ is not None and min(ints) < min_:
+                raise ValidationError("must all be >= %d" % min_)
+            if max_ is not None and max(ints) > max_:
+                raise ValidationError("must all be <= %d" % max_)
+        if numpy is not None:
+            return numpy.frombuffer(ints, dtype=numpy.dtype(
+                'i%d' % ints.itemsize))
+        return ints
+    return f
+
 def Dict(min_=None, max_=None):
     def f(s):
         if not isinstance(s, dict):
@@ -116,6 +234,7 @@ def Dict(min_=None, max_=None):
         return s
     return f
 
+@pure
 def Float(min_=None, max_=None):
     if min_ is not None:
         min_ = float(min_)
@@ -134,6 +253,7 @@ def Float(min_=None, max_=None):
         return v
     return f
 
+@pure
 def StringAlternatives(alt_list):
     for s in alt_list: # Just want to make sure they are strings
         assert isinstance(s, basestring)
@@ -145,6 +265,7 @@ def StringAlternatives(alt_list):
         return s
     return f
 
+@pure
 def Boolean():
     def f(s):
         if isinstance(s, basestring):
@@ -156,6 +277,7 @@ def Boolean():
         raise ValidationError("must be one of 0, 1, on, off, true or false")
     return f
 
+@pure
 def Json():
     def f(s):
         try:
@@ -164,3 +286,148 @@ def Json():
             raise ValidationError("must be valid json")
     return f
 
+
+
+class Optional(object):
+    """ Marks a key of a Schema dict as optional. A missing key is left out
+        of the result, or set to default if one is given. """
+    _missing = object()
+
+    def __init__(self, key, default=_missing):
+        self.key = key
+        self.default = default
+
+    def __repr__(self):
+        return 'Optional(%r)' % (self.key,)
+
+
+class ListOf(object):
+    """ A Schema list with every element matching spec, and optionally
+        length bounds. A plain [spec] is a ListOf(spec) without bounds. """
+
+    def __init__(self, spec, min_=None, max_=None):
+        self.spec = spec
+        self.min_ = min_
+        self.max_ = max_
+
+
+class _SchemaError(ValidationError):
+
+    def __init__(self, message, path):
+        self.message = message
+        self.path = path
+
+
+def Schema(spec, allow_extra=True):
+    """ Compiles a nested spec into one validator for decoded JSON.
+
+        A spec is a validator function (eg. Int(0, 10)), a dict of keys to
+        specs (keys wrapped in Optional may be missing), a ListOf or a one
+        element list [spec]. Dicts and lists are rebuilt with whatever the
+        validators return, in a single pass. Keys not in a dict spec are
+        copied over, or refused if allow_extra is False. Errors give the
+        path to the bad value, eg. "items[2].price: must be >= 0". """
+    check = _compile(spec, allow_extra)
+    def f(s):
+        try:
+            return check(s)
+        except (_SchemaError), e:
+            raise ValidationError("%s: %s" % (_path_str(e.path), e.message))
+    return f
+
+def _path_str(path):
+    parts = []
+    for step in reversed(path):
+        if isinstance(step, (int, long)):
+            parts.append('[%d]' % step)
+        elif parts:
+            parts.append('.%s' % step)
+        else:
+            parts.append('%s' % step)
+    return ''.join(parts) or '(root)'
+
+def _compile(spec, allow_extra):
+    if isinstance(spec, dict):
+        return _compile_dict(spec, allow_extra)
+    if isinstance(spec, list):
+        assert len(spec) == 1, "a list spec takes exactly one element spec"
+        spec = ListOf(spec[0])
+    if isinstance(spec, ListOf):
+        return _compile_list(spec, allow_extra)
+    assert callable(spec), "spec must be a validator, dict, list or ListOf"
+    def leaf(s):
+        try:
+            return spec(s)
+        except (_SchemaError):
+            raise
+        except (ValidationError), e:
+            raise _SchemaError(e.message or "invalid", [])
+        except (TypeError, ValueError):
+            # the stock validators expect query string values, eg. Date()
+            # raises a TypeError when given a JSON number
+            raise _SchemaError("invalid", [])
+    return leaf
+
+def _compile_dict(spec, allow_extra):
+    # (key, check, required, default) in a flat tuple walked once per dict
+    fields = []
+    for key, value_spec in spec.iteritems():
+        default = Optional._missing
+        required = True
+        if isinstance(key, Optional):
+            required = False
+            default = key.default
+            key = key.key
+        fields.append((key, _compile(value_spec, allow_extra), required,
+                       default))
+    fields = tuple(fields)
+    known = frozenset(field[0] for field in fields)
+    missing = Optional._missing
+    def f(s):
+        if not isinstance(s, dict):
+            raise _SchemaError("must be of type dict", [])
+        if allow_extra:
+            result = dict(s)
+        else:
+            for key in s:
+                if key not in known:
+                    raise _SchemaError("unexpected key", [key])
+            result = {}
+        for key, check, required, default in fields:
+            try:
+                value = s[key]
+            except (KeyError):
+                if required:
+                    raise _SchemaError("is required", [key])
+                if default is not missing:
+                    result[key] = default
+                continue
+            try:
+                result[key] = check(value)
+            except (_SchemaError), e:
+                e.path.append(key)
+                raise
+        return result
+    return f
+
+def _compile_list(spec, allow_extra):
+    check = _compile(spec.spec, allow_extra)
+    min_, max_ = spec.min_, spec.max_
+    def f(s):
+        if not isinstance(s, list):
+            raise _SchemaError("must be of type list", [])
+        if min_ and len(s) < min_:
+            raise _SchemaError("list length must be gte %i" % min_, [])
+        if max_ and len(s) > max_:
+            raise _SchemaError("list length must be lte %i" % max_, [])
+        result = []
+        append = result.append
+        index = 0
+        try:
+            for index, value in enumerate(s):
+                append(check(value))
+        except (_SchemaError), e:
+            e.path.append(index)
+            raise
+        return result
+    return f
@@ -401,6 +401,145 @@ class ValidatorTest(unittest.TestCase):
         for input in inputs:
             val_func(input)
 
+    def test_integer_list(self):
+        val_func = vals.IntegerList()
+        self.assertEqual([1, 2, 3, 4], list(val_func([u'1,2', u'3', u'4'])))
+        self.assertEqual([5, 6], list(val_func('5,6')))
+        self.assertEqual([7, 8], list(val_func([7, 8])))
+        self.assertEqual('l', val_func('1').typecode)
+
+    def test_integer_list_fail(self):
+        for input in (['1,,2'], ['1,x'], [1, '2'], [1.5], {}, ['9' * 30]):
+            self.assertRaises(vals.ValidationError, vals.IntegerList(), input)
+
+    def test_integer_list_bounds(self):
+        val_func = vals.IntegerList(min_=1, max_=10, max_count=3)
+        self.assertEqual([1, 10, 5], list(val_func(['1,10,5'])))
+        self.assertRaises(vals.ValidationError, val_func, ['0,5'])
+        self.assertRaises(vals.ValidationError, val_func, ['5,11'])
+        self.assertRaises(vals.ValidationError, val_func, ['1,2', '3,4'])
+        self.assertRaises(vals.ValidationError, val_func, [1, 2, 3, 4])
+
+    #
+    # Schema tests
+    #
+    def _schema_error(self, val_func, input):
+        try:
+            val_func(input)
+        except (vals.ValidationError), e:
+            return e.message
+        self.fail("no ValidationError")
+
+    def test_schema(self):
+        val_func = vals.Schema({
+            "name": vals.String(),
+            "items": [{"price": vals.Float(min_=0)}],
+            vals.Optional("note", default=""): vals.String(),
+        })
+        result = val_func({
+            "name": "a",
+            "items": [{"price": "1.5"}, {"price": 2}],
+            "other": 1,
+        })
+        self.assertEqual({
+            "name": "a",
+            "items": [{"price": 1.5}, {"price": 2.0}],
+            "note": "",
+            "other": 1,
+        }, result)
+
+    def test_schema_paths(self):
+        val_func = vals.Schema({
+            "items": [{"price": vals.Float(min_=0)}],
+            "owner": {"id": vals.Int()},
+        })
+        self.assertEqual("items[1].price: must be >= 0",
+            self._schema_error(val_func, {
+                "items": [{"price": 1}, {"price": -1}],
+                "owner": {"id": 1},
+            }))
+        self.assertEqual("owner.id: is required",
+            self._schema_error(val_func, {"items": [], "owner": {}}))
+        self.assertEqual("(root): must be of type dict",
+            self._schema_error(val_func, []))
+
+    def test_schema_wrong_type_leaf(self):
+        val_func = vals.Schema({"when": vals.Date(), "filter": vals.Json()})
+        self.assertEqual("when: invalid",
+            self._schema_error(val_func, {"when": 5, "filter": "{}"}))
+        self.assertEqual("filter: invalid",
+            self._schema_error(val_func, {"when": "20110101", "filter": 5}))
+
+    def test_json_body_schema_wrong_type(self):
+        req = create_req({"body":'{"when": 5}'})
+        jb = args.JsonBody(schema={"when": vals.Date()})
+        try:
+            jb.argspec(req, None)
+        except (servicepublisher.HTTPException), e:
+            self.assertEqual(400, e.status_code)
+            self.assertEqual("invalid json body: when: invalid", e.message)
+        else:
+            self.fail("no HTTPException")
+
+    def test_schema_optional_missing(self):
+        val_func = vals.Schema({vals.Optional("a"): vals.Int()})
+        self.assertEqual({}, val_func({}))
+
+    def test_schema_no_extra(self):
+        val_func = vals.Schema({"a": vals.Int()}, allow_extra=False)
+        self.assertEqual({"a": 1}, val_func({"a": "1"}))
+        self.assertEqual("b: unexpected key",
+            self._schema_error(val_func, {"a": 1, "b": 2}))
+
+    #
+    # Memoize tests
+    #
+    def test_memoize(self):
+        calls = []
+        def date(s):
+            calls.append(s)
+            return vals.Date()(s)
+        date.pure = True
+        val_func = vals.Memoize(date)
+        self.assertEqual(datetime.date(2011, 1, 1), val_func('20110101'))
+        self.assertEqual(datetime.date(2011, 1, 1), val_func('20110101'))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, val_func.stats()['hits'])
+
+    def test_memoize_failure(self):
+        calls = []
+        def fail(s):
+            calls.append(s)
+            raise vals.ValidationError("bad")
+        fail.pure = True
+        val_func = vals.Memoize(fail)
+        for i in range(2):
+            self.assertRaises(vals.ValidationError, val_func, 'x')
+        self.assertEqual(1, len(calls))
+
+    def test_memoize_mutable_not_cached(self):
+        val_func = vals.Memoize(vals.Json())
+        first = val_func('{"a": 1}')
+        first['b'] = 2
+        self.assertEqual({"a": 1}, val_func('{"a": 1}'))
+        self.assertEqual(0, val_func.stats()['entries'])
+        self.assertEqual(2, val_func.stats()['uncached'])
+
+    def test_memoize_max_len(self):
+        val_func = vals.Memoize(vals.Int(), max_len=4)
+        self.assertEqual(123456, val_func('123456'))
+        self.assertEqual(0, val_func.stats()['entries'])
+
+    @raises(AssertionError)
+    def test_memoize_impure(self):
+        vals.Memoize(vals.String())
+
+    def test_schema_list_of(self):
+        val_func = vals.Schema({"ids": vals.ListOf(vals.Int(), max_=2)})
+        self.assertEqual({"ids": [1, 2]}, val_func({"ids": ["1", 2]}))
+        self.assertEqual("ids: list length must be lte 2",
+            self._schema_error(val_func, {"ids": [1, 2, 3]}))
+
 
 _base_environ = {
     "REQUEST_METHOD": "GET",
@@ -434,6 +573,22 @@ class ArgTest(unittest.TestCase):
         req.body = ''
         self.assertEqual({"yay":12345}, args._get_json_body(req))
 
+    def test_json_body_decoded_once(self):
+        decodes = []
+        json_decode = json.json_decode
+        def counting_decode(o, **kwargs):
+            decodes.append(o)
+            return json_decode(o, **kwargs)
+        json.json_decode = counting_decode
+        try:
+            req = create_json_post_req({"arguments":{},"body":'{"test":"bar"}'})
+            self.assertEqual("bar", args.String("test").argspec(req, None))
+            self.assertEqual({"test":"bar"}, args.JsonBody().argspec(req, None))
+            self.assertEqual("bar", args.JsonBodyField("test").argspec(req, None))
+        finally:
+            json.json_decode = json_decode
+        self.assertEqual(1, len(decodes))
+
     def test_get_no_json_body(self):
         req = create_req({"arguments":{}})
         body = args._get_json_body(req)
@@ -661,6 +816,15 @@ class ArgTest(unittest.TestCase):
         i = args.List("test")
         self.assertEqual([], i.argspec(req, None))
 
+    def test_integer_list_in_args(self):
+        req = create_req({"QUERY_STRING":"id=1,2&id=3"})
+        i = args.IntegerList("id", max_count=10)
+        self.assertEqual([1, 2, 3], list(i.argspec(req, None)))
+        args_, kwargs = servicepublisher.Endpoint(
+            name='', method='GET', uri='/', function=lambda id: id,
+            args=([i], {})).bind(req, {})
+        self.assertEqual([1, 2, 3], list(args_[0]))
+
     def test_dict_in_body(self):
         req = create_json_post_req({
             "body":'{"test":{"two":3}}',
@@ -678,6 +842,33 @@ class ArgTest(unittest.TestCase):
         i = args.Dict("test")
         self.assertEqual([], i.argspec(req, None))
 
+    def test_dict_schema_in_body(self):
+        req = create_json_post_req({
+            "body":'{"test":{"two":"3"}}',
+        })
+        i = args.Dict("test", schema={"two": vals.Int()})
+        self.assertEqual({"two":3}, i.argspec(req, None))
+
+    @raises(servicepublisher.HTTPException)
+    def test_list_schema_in_body_fail(self):
+        req = create_json_post_req({
+            "body":'{"test":[1, "x"]}',
+        })
+        i = args.List("test", schema=[vals.Int()])
+        i.argspec(req, None)
+
+    def test_json_body_schema(self):
+        req = create_req({"body":'{"test":[{"n":"1"}, {"n":"y"}]}'})
+        jb = args.JsonBody(schema={"test": [{"n": vals.Int()}]})
+        try:
+            jb.argspec(req, None)
+        except (servicepublisher.HTTPException), e:
+            self.assertEqual(400, e.status_code)
+            self.assertEqual("invalid json body: test[1].n: must be a number",
+                e.message)
+        else:
+            self.fail("no HTTPException")
+
     def test_uploaded_file(self):
         input = StringIO.StringIO('''
 -----------------------------41184676334
@@ -699,7 +890,78 @@ Some more data about my vacation
         })
 
         upload = args.UploadedFile('upload')
-        assert 'upload' in request.arguments
-        assert 'upload' in request.files
         f = upload.argspec(request, None)
         self.assertIsNotNone(f)
+        self.assertEqual('extra_data.txt', f['filename'])
+        self.assertEqual('Some more data about my vacation', f['file'].read())
+        self.assertEqual(len('Some more data about my vacation'), f['size'])
+
+    def test_endpoint_binder(self):
+        sequential = [
+            args.String("name"),
+            args.Integer("id"),
+            args.Integer("count", optional=True, default=10),
+            args.List("tags", optional=True),
+            args.ClientIp(),
+            args.Boolean("flag", optional=True),
+        ]
+        named = {
+            "when": args.Date("when", optional=True),
+            "limit": args.Integer("limit", max_=5, optional=True),
+            "header": args.RequestHeader("X-Test"),
+        }
+        endpoint = servicepublisher.Endpoint(name='', method='GET',
+            uri='/(?P<id>\d+)$', function=lambda *a, **kw: None,
+            args=(sequential, named))
+
+        def legacy(req, path_args):
+            inargs = servicepublisher._InArgs(req, path_args)
+            kwargs = {}
+            for argname, arg in named.iteritems():
+                r = arg.argspec(req, inargs)
+                if r != None:
+                    kwargs[argname] = r
+            return [arg.argspec(req, inargs) for arg in sequential], kwargs
+
+        def bound(bind, query, path_args, json=None):
+            environ = {"QUERY_STRING": query, "HTTP_X_TEST": "t"}
+            if json:
+                environ.update(body=json, REQUEST_METHOD="POST")
+            try:
+                return bind(create_req(environ), path_args)
+            except (servicepublisher.HTTPException), e:
+                return e.status_code, e.message
+
+        for query, path_args, json in [
+                ("name=a&flag=true&when=20110101", {"id": "1"}, None),
+                ("name=a&id=2&count=3&limit=4", {"id": "1"}, None),
+                ("name=&id=2", {}, None),
+                ("id=2", {}, None),
+                ("name=a", {}, None),
+                ("name=a&id=x", {}, None),
+                ("name=a&id=1&limit=9", {}, None),
+                ("", {"id": "1"}, '{"name": "b", "tags": [1, 2]}'),
+                ]:
+            self.assertEqual(bound(legacy, query, path_args, json),
+                             bound(endpoint.bind, query, path_args, json))
+
+    def test_custom_arg_inargs_is_a_mapping(self):
+        # custom args used to get a plain dict
+        class Merged(args.CustomArg):
+            def __init__(self):
+                def func(req, inargs):
+                    merged = inargs.copy()
+                    inargs['extra'] = 'x'
+                    inargs.setdefault('name', 'unused')
+                    return (inargs.has_key('id'), sorted(inargs.values()),
+                            merged, dict(inargs))
+                self.argspec = func
+        endpoint = servicepublisher.Endpoint(name='', method='GET',
+            uri='/(?P<id>\d+)$', function=lambda *a, **kw: None,
+            args=([Merged()], {}))
+        req = create_req({"QUERY_STRING": "name=a&_method=GET"})
+        has_id, values, merged, after = endpoint.bind(req, {"id": "1"})[0][0]
+        self.assertTrue(has_id)
+        self.assertEqual(['1', 'a', 'x'], values)
+        self.assertEqual({'id': '1', 'name': 'a'}, merged)
+        self.assertEqual({'id': '1', 'name': 'a', 'extra': 'x'}, after)
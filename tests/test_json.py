@@ -18,6 +18,7 @@
 
 
 import datetime
+import StringIO
 from nose.tools import raises
 import nudge.json as json
 import unittest
@@ -30,6 +31,34 @@ class JsonTest(unittest.TestCase):
         result = json.json_ensure_string_keys(dicta)
         self.assertEqual({"1":1,"2":2,"theeeee":now}, result)
 
+    def test_decode_tabs(self):
+        self.assertEqual({"a": "x\ty"}, json.json_decode('{\t"a": "x\ty"}'))
+        self.assertRaises(ValueError, json.json_decode, '{"a": "x\ty"}',
+                          strict=True)
+        self.assertEqual({"a": 1}, json.json_decode('{\t"a": 1}', strict=True))
+
+    def test_iter_json_array(self):
+        data = '[1, -2.5e3 ,{"a": [3, "]"]}, "x,]", true, null]'
+        for chunk_size in (1, 2, 3, 64):
+            self.assertEqual([1, -2500.0, {"a": [3, "]"]}, "x,]", True, None],
+                list(json.iter_json_array(StringIO.StringIO(data),
+                                          chunk_size=chunk_size)))
+        self.assertEqual([],
+            list(json.iter_json_array(StringIO.StringIO(' [ ] '))))
+        for data in ('', '{}', '[1,]', '[1 2]', '[1] x', '[1, 2'):
+            self.assertRaises(ValueError, list,
+                json.iter_json_array(StringIO.StringIO(data), chunk_size=2))
+        self.assertRaises(ValueError, list,
+            json.iter_json_array(StringIO.StringIO('["%s"]' % ('x' * 100)),
+                                 chunk_size=8, max_element_size=50))
+
+    def test_iter_ndjson(self):
+        data = '{"a": 1}\n\n[2]\r\n3'
+        self.assertEqual([{"a": 1}, [2], 3],
+            list(json.iter_ndjson(StringIO.StringIO(data), chunk_size=3)))
+        self.assertRaises(ValueError, list,
+            json.iter_ndjson(StringIO.StringIO('1\n{\n')))
+
     def test_none(self):
         result = json.Dictomatic.wrap(None)
         self.assertEqual({}, result)
@@ -157,5 +186,3 @@ def test_obj_dict_fail():
     d = json.ObjDict.wrap('{"Test":{"test_sub":"test"}}')
     assert d == {"Test":{"test_sub":"test"}}
     print "****** This should die", d.some_ne_attr
-
-
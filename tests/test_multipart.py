@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import hashlib
+import unittest
+import StringIO
+
+from nudge.multipart import parse_multipart, MultipartError
+
+BOUNDARY = 'xYzZY'
+
+
+def _body(parts, newline='\r\n'):
+    lines = ['preamble']
+    for headers, data in parts:
+        lines.append('--' + BOUNDARY)
+        lines.extend(headers)
+        lines.append('')
+        lines.append(data)
+    lines.append('--' + BOUNDARY + '--')
+    lines.append('')
+    return newline.join(lines)
+
+
+def _field(name, value):
+    return (['Content-Disposition: form-data; name="%s"' % name], value)
+
+
+def _file(name, filename, data):
+    return ([
+        'Content-Disposition: form-data; name="%s"; filename="%s"' % (
+            name, filename),
+        'Content-Type: image/png',
+    ], data)
+
+
+class MultipartTest(unittest.TestCase):
+
+    def test_fields_and_files(self):
+        data = ('\x89PNG\r\n--' + BOUNDARY[:-1] + '\n') * 1000
+        body = _body([
+            _field('caption', 'Summer vacation'),
+            _file('upload', 'beach.png', data),
+            _field('tag', 'a'),
+            _field('tag', ''),
+        ])
+        # every chunk size, so separators get split across reads
+        for chunk_size in (1, 2, 7, 64, 4096):
+            fields, files = parse_multipart(
+                StringIO.StringIO(body), BOUNDARY, chunk_size=chunk_size)
+            self.assertEqual(
+                {'caption': 'Summer vacation', 'tag': ['a', '']}, fields)
+            upload = files['upload']
+            self.assertEqual('beach.png', upload.filename)
+            self.assertEqual('image/png', upload.type)
+            self.assertEqual(len(data), upload.size)
+            self.assertEqual(hashlib.md5(data).hexdigest(), upload.digest)
+            self.assertEqual(data, upload.file.read())
+            upload.close()
+
+    def test_bare_newlines(self):
+        body = _body([_field('a', 'one\ntwo'), _file('f', 'x.txt', 'xyz')],
+                     newline='\n')
+        fields, files = parse_multipart(StringIO.StringIO(body), BOUNDARY)
+        self.assertEqual({'a': 'one\ntwo'}, fields)
+        self.assertEqual('xyz', files['f'].value)
+
+    def test_field_too_large(self):
+        body = _body([_field('a', 'x' * 100)])
+        self.assertRaises(MultipartError, parse_multipart,
+            StringIO.StringIO(body), BOUNDARY, max_field_size=99)
+        fields, files = parse_multipart(
+            StringIO.StringIO(body), BOUNDARY, max_field_size=100)
+        self.assertEqual({'a': 'x' * 100}, fields)
+
+    def test_malformed(self):
+        truncated = _body([_file('f', 'x.txt', 'xyz')])[:-20]
+        self.assertRaises(MultipartError, parse_multipart,
+            StringIO.StringIO(truncated), BOUNDARY)
+        self.assertRaises(MultipartError, parse_multipart,
+            StringIO.StringIO(_body([(['Bogus'], 'x')])), BOUNDARY)
+        self.assertRaises(MultipartError, parse_multipart,
+            StringIO.StringIO(''), '')
@@ -117,9 +117,9 @@ def response_buf(http_status, content, content_type='application/json; charset=U
 class StupidTest(unittest.TestCase):
 
     def test_write(self):
-        req = json.Dictomatic({"_buffer":""})
+        req = sp.WSGIRequest({'REQUEST_METHOD': 'GET'})
         sp._write(req, "test")
-        self.assertEqual(req._buffer, "test")
+        self.assertEqual("test", req.getvalue())
 
     def test_args(self):
         self.assertEqual(([], {}), sp.Args())
@@ -238,6 +238,82 @@ class HandlerTest(unittest.TestCase):
         resp.write(result)
         self.assertEqual(req._buffer,response_buf(404, '{"message": "Not Found", "code": 404}'))
 
+    def test_method_not_allowed(self):
+        def handler(): pass
+
+        sp = ServicePublisher(options={'method_not_allowed': True})
+        sp.add_endpoint(Endpoint(name='', method='GET', uri='/location', function=handler))
+        req = create_req('DELETE', '/location')
+        resp = MockResponse(req, 200)
+        result = sp(req, resp.start_response)
+        resp.write(result)
+        self.assertEqual(req._buffer,response_buf(405, '{"message": "Method Not Allowed", "code": 405}'))
+
+        req = create_req('GET', '/blah')
+        resp = MockResponse(req, 200)
+        result = sp(req, resp.start_response)
+        resp.write(result)
+        self.assertEqual(req._buffer,response_buf(404, '{"message": "Not Found", "code": 404}'))
+
+    def test_route_cache(self):
+        def handler(user): return dict(name=user)
+
+        sp = ServicePublisher(options={'route_cache_size': 8})
+        sp.add_endpoint(Endpoint(name='', method='GET', uri='/(?P<user>\w+)/profile$', args=([args.String('user')],{}), function=handler))
+        for i in range(3):
+            req = create_req('GET', '/bob/profile')
+            resp = MockResponse(req, 200)
+            result = sp(req, resp.start_response)
+            resp.write(result)
+            self.assertEqual(req._buffer,response_buf(200, '{"name": "bob"}'))
+        for i in range(2):
+            req = create_req('GET', '/nobody')
+            resp = MockResponse(req, 200)
+            result = sp(req, resp.start_response)
+            resp.write(result)
+            self.assertEqual(req._buffer,response_buf(404, '{"message": "Not Found", "code": 404}'))
+        stats = sp.stats()['route_cache']
+        self.assertEqual((3, 2), (stats['hits'], stats['misses']))
+
+        # adding an endpoint must forget the cached 404
+        sp.add_endpoint(Endpoint(name='', method='GET', uri='/nobody$', function=lambda: dict(name='nobody')))
+        req = create_req('GET', '/nobody')
+        resp = MockResponse(req, 200)
+        result = sp(req, resp.start_response)
+        resp.write(result)
+        self.assertEqual(req._buffer,response_buf(200, '{"name": "nobody"}'))
+
+    def test_validator_cache_stats(self):
+        def handler(day): return dict(year=day.year)
+
+        sp = ServicePublisher()
+        sp.add_endpoint(Endpoint(name='by_day', method='GET', uri='/day/(?P<day>\d+)$', args=([args.Date('day', memoize=True)],{}), function=handler))
+        for i in range(3):
+            req = create_req('GET', '/day/20110101')
+            resp = MockResponse(req, 200)
+            result = sp(req, resp.start_response)
+            resp.write(result)
+            self.assertEqual(req._buffer,response_buf(200, '{"year": 2011}'))
+        stats = sp.stats()['validator_cache']['by_day.day']
+        self.assertEqual((2, 1), (stats['hits'], stats['misses']))
+
+    def test_risky_route_long_path(self):
+        def handler(a, b): return dict(a=a)
+
+        sp = ServicePublisher(options={'max_risky_path_length': 64})
+        sp.add_endpoint(Endpoint(name='', method='GET', uri='/(?P<a>.*)/(?P<b>.*)/x$', args=([args.String('a'), args.String('b')],{}), function=handler))
+        req = create_req('GET', '/q/r/x')
+        resp = MockResponse(req, 200)
+        result = sp(req, resp.start_response)
+        resp.write(result)
+        self.assertEqual(req._buffer,response_buf(200, '{"a": "q"}'))
+
+        req = create_req('GET', '/q' * 40 + '/x')
+        resp = MockResponse(req, 200)
+        result = sp(req, resp.start_response)
+        resp.write(result)
+        self.assertEqual(req._buffer,response_buf(414, '{"message": "Request-URI Too Long", "code": 414}'))
+
     def test_noargs_but_method_handlersuccess(self):
         def handler(): return dict(arg1=1)
 
@@ -391,6 +467,51 @@ class CookieTest(unittest.TestCase):
             json.json_decode(result[0])
         )
 
+class VirtualHostTest(unittest.TestCase):
+
+    def _sp(self):
+        def endpoint(name):
+            return Endpoint(name=name, method='GET', uri='/who$', function=lambda: dict(name=name))
+        return ServicePublisher(
+            endpoints=[endpoint('default')],
+            hosts={
+                'api.example.com': [endpoint('api')],
+                '*.tenants.example.com': [endpoint('tenant')],
+            },
+        )
+
+    def _who(self, sp, host):
+        req = create_req('GET', '/who', headers={'host': host})
+        resp = MockResponse(req, 200)
+        return json.json_decode(sp(req, resp.start_response)[0])
+
+    def test_exact_host(self):
+        sp = self._sp()
+        self.assertEqual({'name': 'api'}, self._who(sp, 'api.example.com'))
+        self.assertEqual({'name': 'api'}, self._who(sp, 'API.example.com:8080'))
+
+    def test_wildcard_host(self):
+        sp = self._sp()
+        self.assertEqual({'name': 'tenant'}, self._who(sp, 'acme.tenants.example.com'))
+        self.assertEqual({'name': 'default'}, self._who(sp, 'a.b.tenants.example.com'))
+        self.assertEqual({'name': 'default'}, self._who(sp, 'tenants.example.com'))
+
+    def test_unknown_host(self):
+        sp = self._sp()
+        self.assertEqual({'name': 'default'}, self._who(sp, 'localhost'))
+
+    def test_host_routes_are_separate(self):
+        sp = self._sp()
+        sp.add_endpoint(Endpoint(name='', method='GET', uri='/only-api$', function=lambda: dict(only=True)), host='api.example.com')
+        req = create_req('GET', '/only-api', headers={'host': 'localhost'})
+        resp = MockResponse(req, 200)
+        sp(req, resp.start_response)
+        self.assertEqual('404 Not Found', resp.status)
+        req = create_req('GET', '/only-api', headers={'host': 'api.example.com'})
+        resp = MockResponse(req, 200)
+        sp(req, resp.start_response)
+        self.assertEqual('200 OK', resp.status)
+
 class FallbackAppTest(unittest.TestCase):
     '''
     TODO test using the post body in the fallback app.
@@ -463,6 +584,7 @@ class FallbackAppTest(unittest.TestCase):
 
         body = json.json_encode({'success': True}) + '\r\n'
         req = create_req('POST', '/not-test', body=body)
+        input = req['wsgi.input']
         resp = MockResponse(req, 200)
         result = sp(req, resp.start_response)
 
@@ -470,6 +592,10 @@ class FallbackAppTest(unittest.TestCase):
             {'success': True},
             json.json_decode(result[0])
         )
+        # the original input, streamed straight through
+        self.assertTrue(req['wsgi.input'] is input)
+        self.assertEqual({'passthrough': 1, 'rewound': 0},
+                         sp.stats()['fallback'])
 
     def test_fallback_app_not_used(self):
 
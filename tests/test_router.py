@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import sys
+import threading
+import unittest
+import warnings
+
+from nose.tools import raises
+
+from nudge.error import HTTPException
+from nudge.publisher import Endpoint
+from nudge.router import Router, redos_risk, REDOS_EXPONENTIAL,\
+    REDOS_POLYNOMIAL
+
+
+def _ep(name, uri, method='GET'):
+    return Endpoint(name=name, method=method, uri=uri, function=lambda: None)
+
+
+def _linear(endpoints, method, path):
+    """ The original ServicePublisher dispatch loop """
+    reqline = method + path
+    for endpoint in endpoints:
+        match = endpoint.match(reqline)
+        if match:
+            return endpoint, match.groupdict()
+    return None, None
+
+
+class RouterTest(unittest.TestCase):
+
+    def _router(self, endpoints):
+        router = Router()
+        for endpoint in endpoints:
+            router.add(endpoint)
+        return router
+
+    def test_literal(self):
+        health = _ep('health', '/health$')
+        router = self._router([_ep('root', '/$'), health])
+        self.assertEqual((health, {}), router.match('GET', '/health'))
+        self.assertEqual((None, None), router.match('GET', '/healthz'))
+        self.assertEqual((None, None), router.match('POST', '/health'))
+
+    def test_captures(self):
+        user = _ep('user', '/users/(?P<user_id>\d+)/posts/(?P<slug>[^/]+)$')
+        router = self._router([user])
+        self.assertEqual(
+            (user, {'user_id': '12', 'slug': 'hello'}),
+            router.match('GET', '/users/12/posts/hello')
+        )
+        self.assertEqual((None, None), router.match('GET', '/users/ab/posts/x'))
+
+    def test_unanchored_is_prefix(self):
+        location = _ep('location', '/location')
+        router = self._router([location])
+        self.assertEqual((location, {}), router.match('GET', '/location'))
+        self.assertEqual((location, {}), router.match('GET', '/locations/1'))
+        self.assertEqual((None, None), router.match('GET', '/loc'))
+
+    def test_optional_slash(self):
+        users = _ep('users', '/users/?$')
+        router = self._router([users])
+        self.assertEqual((users, {}), router.match('GET', '/users'))
+        self.assertEqual((users, {}), router.match('GET', '/users/'))
+        self.assertEqual((None, None), router.match('GET', '/users//'))
+
+    def test_first_match_wins(self):
+        # The catch-all can span slashes so it stays a regex, but it was
+        # registered first and must still win over the later literal route.
+        catch_all = _ep('catch_all', '/static/(?P<filename>.*)$')
+        literal = _ep('literal', '/static/app.js$')
+        router = self._router([catch_all, literal])
+        self.assertEqual(
+            (catch_all, {'filename': 'app.js'}),
+            router.match('GET', '/static/app.js')
+        )
+        router = self._router([literal, catch_all])
+        self.assertEqual((literal, {}), router.match('GET', '/static/app.js'))
+
+    def test_first_match_wins_in_tree(self):
+        capture = _ep('capture', '/users/(?P<user>[^/]+)$')
+        me = _ep('me', '/users/me$')
+        router = self._router([capture, me])
+        self.assertEqual(
+            (capture, {'user': 'me'}), router.match('GET', '/users/me'))
+
+    def test_static_table(self):
+        root = _ep('root', '/$')
+        users = _ep('users', '/api/v1/users/?$')
+        router = self._router([root, users, _ep('post', '/$', method='POST')])
+        self.assertEqual((root, {}), router.match('GET', '/'))
+        self.assertEqual((users, {}), router.match('GET', '/api/v1/users/'))
+        self.assertEqual(
+            ['/', '/api/v1/users', '/api/v1/users/'],
+            sorted(router._static['GET'].keys())
+        )
+        self.assertEqual(0, len(router._trees))
+
+    def test_static_shadowed_by_earlier_route(self):
+        capture = _ep('capture', '/users/(?P<user>\w+)$')
+        me = _ep('me', '/users/me$')
+        other = _ep('other', '/other$')
+        router = self._router([capture, me, other])
+        self.assertEqual(
+            (capture, {'user': 'me'}), router.match('GET', '/users/me'))
+        self.assertEqual((other, {}), router.match('GET', '/other'))
+        # later routes never change an answer that is already in the table
+        router.add(_ep('late', '/other$'))
+        self.assertEqual((other, {}), router.match('GET', '/other'))
+
+    def test_static_table_concurrent_first_match(self):
+        endpoints = [_ep('s%d' % i, '/static%d$' % i) for i in range(50)]
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for trial in range(100):
+                router = self._router(endpoints)
+                results = []
+                def match():
+                    results.append(router.match('GET', '/static49')[0])
+                threads = [threading.Thread(target=match) for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual([endpoints[49]] * 4, results)
+        finally:
+            sys.setcheckinterval(interval)
+
+    def test_static_table_no_hits(self):
+        # working out the static table doesn't count as regex traffic
+        router = Router(reorder_interval=0)
+        router.add(_ep('regex', '/(?P<a>.*)/b$'))
+        router.add(_ep('static', '/a/b$'))
+        self.assertEqual('regex', router.match('GET', '/a/b')[0].name)
+        self.assertEqual(0, router._regex_dispatches)
+        self.assertEqual(0, router._regex_routes[0].hits)
+
+    def test_allows(self):
+        router = self._router([_ep('a', '/a$'), _ep('b', '/b/(?P<x>.*)$')])
+        self.assertTrue(router.allows('GET'))
+        self.assertFalse(router.allows('DELETE'))
+        self.assertEqual((None, None), router.match('DELETE', '/a'))
+        router.add(_ep('any', '/c$', method='(?:PUT|DELETE)'))
+        self.assertTrue(router.allows('DELETE'))
+
+    def test_regex_routes_share_alternation(self):
+        # Both routes use the same group name and neither fits the tree
+        first = _ep('first', '/a/(?P<rest>.*)/x$')
+        second = _ep('second', '/b/(?P<rest>.*)/y$')
+        router = self._router([first, second])
+        self.assertEqual(
+            (second, {'rest': '1/2'}), router.match('GET', '/b/1/2/y'))
+        self.assertEqual(
+            (first, {'rest': '1'}), router.match('GET', '/a/1/x'))
+        self.assertEqual(1, len(router._blocks))
+
+    def test_alternation_unmatched_groups(self):
+        ep = _ep('ep', '/a/(?P<x>.*)/(?:(?P<y>\d+)|z)$')
+        router = self._router([ep])
+        self.assertEqual(
+            (ep, {'x': 'q/r', 'y': None}), router.match('GET', '/a/q/r/z'))
+
+    def test_alternation_backreference(self):
+        plain = _ep('plain', '/p/(?P<rest>.*)$')
+        backref = _ep('backref', '/(?P<a>.*)/(?P=a)$')
+        router = self._router([backref, plain])
+        self.assertEqual(
+            (backref, {'a': 'x/y'}), router.match('GET', '/x/y/x/y'))
+        self.assertEqual(
+            (plain, {'rest': 'q'}), router.match('GET', '/p/q'))
+        self.assertEqual(2, len(router._blocks))
+
+    def test_alternation_group_limit(self):
+        # 50 routes of two groups each (capture + marker) is one too many
+        endpoints = [_ep('e%d' % i, '/e%d/(?P<a>.+)$' % i)
+                     for i in range(100)]
+        router = self._router(endpoints)
+        self.assertEqual(
+            (endpoints[99], {'a': '1/2'}), router.match('GET', '/e99/1/2'))
+        self.assertTrue(len(router._blocks) > 1)
+
+    def test_reorder_hot_routes(self):
+        cold = _ep('cold', '/cold/(?P<rest>.*)$')
+        hot = _ep('hot', '/hot/(?P<rest>.*)$')
+        router = Router(reorder_interval=10)
+        router.add(cold)
+        router.add(hot)
+        for i in range(10):
+            self.assertEqual(
+                (hot, {'rest': 'x'}), router.match('GET', '/hot/x'))
+        self.assertEqual(
+            ['hot', 'cold'], [r.endpoint.name for r in router._regex_routes])
+        self.assertEqual(
+            (cold, {'rest': 'y'}), router.match('GET', '/cold/y'))
+
+    def test_reorder_off_by_default(self):
+        cold = _ep('cold', '/cold/(?P<rest>.*)$')
+        hot = _ep('hot', '/hot/(?P<rest>.*)$')
+        router = self._router([cold, hot])
+        for i in range(2000):
+            router.match('GET', '/hot/x')
+        self.assertEqual(
+            ['cold', 'hot'], [r.endpoint.name for r in router._regex_routes])
+
+    def test_reorder_reuses_branches(self):
+        router = Router(reorder_interval=3)
+        for name in ('a', 'b', 'c'):
+            router.add(_ep(name, '/%s/(?P<rest>.*)$' % name))
+        router.match('GET', '/a/x')
+        branches = [r.branch for r in router._regex_routes]
+        router.match('GET', '/c/x')
+        router.match('GET', '/c/x')
+        self.assertEqual('c', router._regex_routes[0].endpoint.name)
+        self.assertEqual(sorted(branches),
+                         sorted([r.branch for r in router._regex_routes]))
+        self.assertTrue(router._regex_routes[0].branch in branches)
+        self.assertEqual(
+            'b', router.match('GET', '/b/y')[0].name)
+
+    def test_reorder_keeps_overlapping_routes(self):
+        # Everything starts with 'GET/' so the catch all may overlap with
+        # both of the later routes and has to stay in front of them.
+        catch_all = _ep('catch_all', '/(?P<a>.*)/x$')
+        hot = _ep('hot', '/hot/(?P<rest>.*)$')
+        other = _ep('other', '/other/(?P<rest>.*)$')
+        router = Router(reorder_interval=5)
+        for ep in (catch_all, other, hot):
+            router.add(ep)
+        for i in range(5):
+            router.match('GET', '/hot/y')
+        self.assertEqual(
+            ['catch_all', 'hot', 'other'],
+            [r.endpoint.name for r in router._regex_routes]
+        )
+        self.assertEqual(
+            (catch_all, {'a': 'hot'}), router.match('GET', '/hot/x'))
+
+    def test_reorder_against_tree(self):
+        tree = _ep('tree', '/hot/(?P<rest>\w+)$')
+        hot = _ep('hot', '/hot/(?P<rest>.*)$')
+        router = Router(reorder_interval=1)
+        router.add(tree)
+        router.add(hot)
+        self.assertEqual((hot, {'rest': 'a/b'}), router.match('GET', '/hot/a/b'))
+        self.assertEqual((tree, {'rest': 'ab'}), router.match('GET', '/hot/ab'))
+
+    def test_matches_linear_scan(self):
+        endpoints = [
+            _ep('a', '/$'),
+            _ep('b', '/users/(?P<user_id>\d+)$'),
+            _ep('c', '/users/new$'),
+            _ep('d', '/users/(?P<user_id>\d+)/edit'),
+            _ep('e', '/(?P<user>.*)/profile'),
+            _ep('f', '/profiles/(?P<user>\w+)/?$'),
+            _ep('g', '/files/(?P<name>[a-z]+)\.(?P<ext>json|xml)$'),
+            _ep('h', '/files/'),
+            _ep('i', '/users/(?P<user_id>\d+)$', method='POST'),
+            _ep('j', '/api/v1/users$'),
+            _ep('k', '/users/12$'),
+            _ep('l', '/files/a.json$'),
+            _ep('m', '/files/index$'),
+            _ep('n', '/a|b/c$', method='POST'),
+            _ep('o', '/(?P<x>[^/]+)|/b', method='PUT'),
+        ]
+        router = self._router(endpoints)
+        router.reorder_interval = 3
+        paths = [
+            '/', '', '/users/12', '/users/new', '/users/12/edit',
+            '/users/12/editor', '/bob/profile', '/profiles/bob',
+            '/profiles/bob/', '/profiles/bob/x', '/files/a.json',
+            '/files/a.txt', '/files/', '/files', '/api/v1/users',
+            '/api/v1/users/', '/users/12\n', '/nope', '/files/index',
+            '/a', '/b/c', '/a/c', '/b', '/x/y',
+        ]
+        for method in ('GET', 'POST', 'PUT'):
+            for path in paths:
+                self.assertEqual(
+                    _linear(endpoints, method, path),
+                    router.match(method, path),
+                    "%s %r" % (method, path)
+                )
+
+
+class RedosTest(unittest.TestCase):
+
+    def test_exponential(self):
+        for pattern in ['GET/(a+)+$', 'GET/(\\w+\\s?)*$', 'GET/(a|aa)*$',
+                        'GET/(\\w|\\d)+$', 'GET/(?P<x>(\\d+)*)$',
+                        'GET/(?:a|a)+$', 'GET/(?:ab|ab)+$',
+                        'GET/(?:a?|b?)+$']:
+            self.assertEqual(REDOS_EXPONENTIAL, redos_risk(pattern)[0], pattern)
+
+    def test_polynomial(self):
+        for pattern in ['GET/(?P<a>.*)/(?P<b>.*)$', 'GET/(?P<x>.*)x(?P<y>.*)$']:
+            self.assertEqual(REDOS_POLYNOMIAL, redos_risk(pattern)[0], pattern)
+
+    def test_safe(self):
+        for pattern in ['GET/static/(?P<filename>.*)$',
+                        'GET/(?P<user>.*)/profile',
+                        'GET/users/(?P<id>\\d+)/(?P<slug>[^/]+)$',
+                        'GET/(?P<a>\\d+)-(?P<b>\\d+)$',
+                        'GET/files(?:/[^/]+)*$',
+                        'GET/(?:(?P<x>\\w+)-)+$',
+                        'GET/(a|ab)*$']:
+            self.assertEqual(None, redos_risk(pattern)[0], pattern)
+
+    @raises(ValueError)
+    def test_safe_mode_rejects(self):
+        router = Router(safe=True)
+        router.add(_ep('bad', '/(?P<x>(a+)+)$'))
+
+    def test_warns(self):
+        router = Router()
+        caught = []
+        original = warnings.showwarning
+        warnings.showwarning = lambda *a, **kw: caught.append(a[0])
+        try:
+            router.add(_ep('bad', '/(?P<x>(a+)+)$'))
+        finally:
+            warnings.showwarning = original
+        self.assertEqual(1, len(caught))
+        self.assertTrue('nested quantifier' in str(caught[0]))
+        # risky segments are never put in the tree
+        self.assertEqual(1, len(router._regex_routes))
+
+    def test_path_length_cap(self):
+        risky = _ep('risky', '/(?P<a>.*)/(?P<b>.*)/x$')
+        router = Router(max_risky_length=20)
+        router.add(risky)
+        self.assertEqual(
+            (risky, {'a': 'q', 'b': 'r'}), router.match('GET', '/q/r/x'))
+        self.assertRaises(
+            HTTPException, router.match, 'GET', '/' + 'a/' * 20 + 'x')
+
+    def test_path_length_cap_earlier_match(self):
+        safe = _ep('safe', '/files/(?P<name>.*)$')
+        risky = _ep('risky', '/(?P<a>.*)/(?P<b>.*)/x$')
+        router = Router(max_risky_length=20)
+        router.add(safe)
+        router.add(risky)
+        path = '/files/' + 'a' * 30
+        self.assertEqual((safe, {'name': 'a' * 30}), router.match('GET', path))
+        # the risky route came first, so there is no safe answer
+        router = Router(max_risky_length=20)
+        router.add(risky)
+        router.add(safe)
+        self.assertRaises(HTTPException, router.match, 'GET', path)
+
+
+if __name__ == '__main__':
+    unittest.main()
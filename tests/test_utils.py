@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2011 Evite LLC
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from nudge.utils import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(1, cache.get('a'))
+        cache['c'] = 3
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(2, len(cache))
+
+    def test_update_existing(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['a'] = 2
+        self.assertEqual(2, cache.get('a'))
+        self.assertEqual(1, len(cache))
+
+    def test_stats(self):
+        cache = LRUCache(4)
+        cache['a'] = 1
+        cache.get('a')
+        cache.get('b')
+        cache.get('b', 'default')
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache.clear()
+        self.assertEqual(None, cache.get('a'))
+        cache['b'] = 2
+        cache['c'] = 3
+        cache['d'] = 4
+        self.assertEqual(['c', 'd'], sorted(cache._map.keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,49 @@ import unittest
 
 import StringIO
 
-from nudge.publisher import WSGIRequest
+import nudge.arg as args
+import nudge.validator as vals
+from nudge.error import HTTPException
+from nudge.renderer import Written
+from nudge.publisher import WSGIRequest, ServicePublisher, Endpoint,\
+    EnvironView, parse_query_string, parse_cookies, cookie_values
+
+
+class CountingInput(object):
+
+    def __init__(self, data=''):
+        self.reads = 0
+        self._input = StringIO.StringIO(data)
+
+    def read(self, *args):
+        self.reads += 1
+        return self._input.read(*args)
+
+_BOUNDARY = '---------------------------41184676334'
+_MULTIPART = '''
+-----------------------------41184676334
+Content-Disposition: form-data; name="caption"
+
+Summer vacation
+-----------------------------41184676334
+Content-Disposition: form-data; name="upload"; filename="extra_data.txt"
+Content-Type: text/plain
+
+Some more data about my vacation
+-----------------------------41184676334--
+'''
+
+def _post_multipart(sp, path):
+    responses = []
+    body = sp({
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': path,
+        'REMOTE_ADDR': '127.0.0.1',
+        'CONTENT_TYPE': 'multipart/form-data; boundary=' + _BOUNDARY,
+        'CONTENT_LENGTH': str(len(_MULTIPART)),
+        'wsgi.input': StringIO.StringIO(_MULTIPART),
+    }, lambda status, headers: responses.append(status))
+    return responses[0], ''.join(body)
 
 class WSGIRequestTest(unittest.TestCase):
 
@@ -31,6 +73,134 @@ class WSGIRequestTest(unittest.TestCase):
         assert req.headers['X-Forwarded-For'] == '10.0.10.123'
         assert req.headers.get('X-Forwarded-For') == '10.0.10.123', req.headers.get('X-Forwarded-For')
 
+    def test_headers_view(self):
+        environ = {
+            'REQUEST_METHOD':'GET',
+            'REMOTE_ADDR':'127.0.0.1',
+            'CONTENT_TYPE': 'text/plain',
+            'HTTP_X_FORWARDED_FOR': '10.0.0.1, 10.0.0.2,10.0.0.3',
+            'HTTP_ACCEPT': 'text/html;q="a,b", */*',
+            'wsgi.input': StringIO.StringIO(),
+        }
+        req = WSGIRequest(environ)
+        self.assertEqual('text/plain', req.headers['Content-Type'])
+        self.assertEqual('text/plain', req.headers.get('content-type'))
+        self.assertTrue('x-forwarded-for' in req.headers)
+        self.assertFalse('X-Missing' in req.headers)
+        self.assertRaises(KeyError, lambda: req.headers['X-Missing'])
+        self.assertEqual('none', req.headers.get('X-Missing', 'none'))
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+                         req.headers.getlist('X-Forwarded-For'))
+        self.assertEqual(['text/html;q="a,b"', '*/*'],
+                         req.headers.getlist('Accept'))
+        self.assertEqual([], req.headers.getlist('X-Missing'))
+        self.assertEqual({'content_type': 'text/plain',
+                          'x_forwarded_for': '10.0.0.1, 10.0.0.2,10.0.0.3',
+                          'accept': 'text/html;q="a,b", */*'},
+                         dict(req.headers.items()))
+        # looked up on demand, not copied
+        environ['HTTP_X_LATE'] = 'yes'
+        self.assertEqual('yes', req.headers['X-Late'])
+
+    def test_body_is_lazy(self):
+        input = CountingInput('{"a": 1}')
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'wsgi.input': input,
+        })
+        self.assertEqual(0, input.reads)
+        self.assertFalse(req.body_read())
+        self.assertEqual('{"a": 1}', req.body)
+        self.assertEqual('{"a": 1}', req.body)
+        self.assertEqual(1, input.reads)
+        self.assertTrue(req.body_read())
+
+    def test_unused_body_not_read(self):
+        input = CountingInput('x' * 1000)
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='GET', uri='/$', function=lambda: {})
+        ])
+        for path in ('/', '/404'):
+            sp({
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': path,
+                'REMOTE_ADDR': '127.0.0.1',
+                'wsgi.input': input,
+            }, lambda status, headers: None)
+        self.assertEqual(0, input.reads)
+
+    def test_declared_body_too_large(self):
+        input = CountingInput('x' * 100)
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'CONTENT_LENGTH': '100',
+            'wsgi.input': input,
+        })
+        req.max_body_size = 10
+        try:
+            req.body
+            self.fail('expected a 413')
+        except (HTTPException), e:
+            self.assertEqual(413, e.status_code)
+        self.assertEqual(0, input.reads)
+
+    def test_chunked_body_too_large(self):
+        input = CountingInput('x' * 1000000)
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'wsgi.input': input,
+        })
+        req.max_body_size = 10
+        self.assertRaises(HTTPException, getattr, req, 'body')
+        self.assertEqual(11, input._input.tell())
+
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'wsgi.input': CountingInput('x' * 10),
+        })
+        req.max_body_size = 10
+        self.assertEqual('x' * 10, req.body)
+
+    def test_publisher_body_limits(self):
+        sp = ServicePublisher(options={'max_body_size': 100}, endpoints=[
+            Endpoint(name='', method='POST', uri='/big$', function=lambda: {}),
+            Endpoint(name='', method='POST', uri='/small$',
+                     function=lambda: {}, max_body_size=10),
+            Endpoint(name='', method='POST', uri='/upload$',
+                     function=lambda: {}, max_body_size=1000),
+        ], fallbackapp=lambda environ, start_response:
+            start_response('200 OK', []) or [environ['wsgi.input'].read()])
+        def call(path, length):
+            statuses = []
+            input = CountingInput('x' * length)
+            sp({
+                'REQUEST_METHOD': 'POST',
+                'PATH_INFO': path,
+                'REMOTE_ADDR': '127.0.0.1',
+                'CONTENT_LENGTH': str(length),
+                'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+                'HTTP_EXPECT': '100-continue',
+                'HTTP_HOST': 'localhost',
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': input,
+            }, lambda status, headers: statuses.append(status))
+            return statuses[0], input.reads
+
+        self.assertEqual(('413 Request Entity Too Large', 0), call('/big', 101))
+        self.assertEqual('200 OK', call('/big', 100)[0])
+        self.assertEqual('413 Request Entity Too Large', call('/small', 50)[0])
+        self.assertEqual('200 OK', call('/small', 10)[0])
+        # an endpoint's limit can be higher than the publisher's
+        self.assertEqual('200 OK', call('/upload', 1000)[0])
+        self.assertEqual('413 Request Entity Too Large',
+                         call('/upload', 1001)[0])
+        # the fallback app gets whatever it is sent
+        self.assertEqual('200 OK', call('/other', 5000)[0])
+
     def test_request_files(self):
         input = StringIO.StringIO('''
 -----------------------------41184676334
@@ -53,7 +223,324 @@ Some more data about my vacation
 
         args = request.arguments
         assert args['caption'] == 'Summer vacation'
-        assert args['upload'] == 'Some more data about my vacation'
+        assert args['upload'] is request.files['upload']
         assert len(request.files) == 1, 'should have parsed a single file'
         assert request.files['upload'].filename == 'extra_data.txt'
         assert request.files['upload'].value.strip() == 'Some more data about my vacation'
+
+    def test_spooled_body(self):
+        data = 'x' * 100 + 'y' * 100
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'CONTENT_LENGTH': '200',
+            'wsgi.input': StringIO.StringIO(data),
+        })
+        req.spool_threshold = 150
+        self.assertEqual(200, req.body_size())
+        self.assertTrue(req.body_file.fileno() >= 0)
+        self.assertEqual(data, req.body_file.read())
+        self.assertEqual('y' * 100, req.body_view()[100:])
+        self.assertEqual(data, req.body)
+
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'wsgi.input': StringIO.StringIO(data),
+        })
+        self.assertEqual(data, req.body_file.read())
+        self.assertEqual(data, req.body_view().tobytes())
+
+    def test_spooled_request_files(self):
+        input = StringIO.StringIO('''
+-----------------------------41184676334
+Content-Disposition: form-data; name="caption"
+
+Summer vacation
+-----------------------------41184676334
+Content-Disposition: form-data; name="upload"; filename="extra_data.txt"
+Content-Type: text/plain
+
+Some more data about my vacation
+-----------------------------41184676334--
+''')
+        request = WSGIRequest({
+            'REQUEST_METHOD': 'POST',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_TYPE': 'multipart/form-data; boundary=---------------------------41184676334',
+            'wsgi.input': input,
+        })
+        request.spool_threshold = 16
+
+        args = request.arguments
+        assert args['caption'] == 'Summer vacation'
+        assert request.files['upload'].value.strip() == 'Some more data about my vacation'
+        # the parts were read from wsgi.input, the body wasn't spooled too
+        self.assertFalse(request.body_read())
+
+    def test_publisher_uploaded_file(self):
+        def upload(f):
+            return {'filename': f['filename'], 'data': f['file'].read()}
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='POST', uri='/upload$', function=upload,
+                     args=([args.UploadedFile('upload')], {})),
+        ])
+        status, body = _post_multipart(sp, '/upload')
+        self.assertEqual('200 OK', status)
+        self.assertTrue('extra_data.txt' in body)
+        self.assertTrue('Some more data about my vacation' in body)
+
+    def test_other_bodies_not_read(self):
+        input = CountingInput('x' * 200000)
+        req = WSGIRequest({
+            'REQUEST_METHOD': 'POST',
+            'REMOTE_ADDR': '127.0.0.1',
+            'QUERY_STRING': 'name=a',
+            'CONTENT_TYPE': 'application/octet-stream',
+            'CONTENT_LENGTH': '200000',
+            'wsgi.input': input,
+        })
+        self.assertEqual([u'a'], req.arguments['name'])
+        self.assertEqual(0, input.reads)
+        self.assertFalse(req.body_read())
+
+    def test_publisher_multipart_and_body(self):
+        def both(caption, body):
+            return {'caption': caption, 'size': len(body)}
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='POST', uri='/both$', function=both,
+                     args=([args.String('caption'), args.Body()], {})),
+        ])
+        status, body = _post_multipart(sp, '/both')
+        self.assertEqual('200 OK', status)
+        self.assertTrue('Summer vacation' in body)
+        self.assertTrue('"size": %d' % len(_MULTIPART) in body)
+
+    def test_environ_not_copied(self):
+        environ = {
+            'REQUEST_METHOD':'GET',
+            'REMOTE_ADDR':'127.0.0.1',
+            'PATH_INFO': '/a',
+            'wsgi.input': StringIO.StringIO(),
+        }
+        req = WSGIRequest(environ)
+        self.assertTrue(req.environ is environ)
+        self.assertEqual('/a', req.req.PATH_INFO)
+        self.assertEqual('/a', req.req['PATH_INFO'])
+        self.assertEqual(None, req.req.QUERY_STRING)
+        environ['QUERY_STRING'] = 'a=1'
+        self.assertEqual('a=1', req.req.get('QUERY_STRING'))
+        self.assertRaises(AttributeError, setattr, req.req, 'PATH_INFO', '/b')
+        self.assertRaises(AttributeError, setattr, req, 'unknown', 1)
+        self.assertTrue(isinstance(req.req, EnvironView))
+
+    def test_parse_query_string(self):
+        self.assertEqual(
+            {u'a': [u'1', u'2'], u'b': [u'x y'], u'c=': [u'&'], u'f': [u'']},
+            parse_query_string('a=1&b=x+y&a=2&c%3D=%26&f=&g&h=i=j'))
+        result = parse_query_string('name=caf%C3%A9&bad=%FF&ok=1')
+        self.assertEqual({u'name': [u'caf\xe9'], u'ok': [u'1']}, result)
+        self.assertTrue(isinstance(result.keys()[0], unicode))
+
+        # cached results are handed out as new lists
+        first = parse_query_string('poll=1&poll=2')
+        first['poll'].append(u'3')
+        self.assertEqual({u'poll': [u'1', u'2']},
+                         parse_query_string('poll=1&poll=2'))
+
+    def test_parse_cookies(self):
+        header = 'a=1; b = two ;c=x=y; flag; a=3;q="semi;colon\\073\\"";e='
+        self.assertEqual({'a': ['1', '3'], 'b': ['two'], 'c': ['x=y'],
+                          'q': ['semi;colon;"'], 'e': ['']},
+                         parse_cookies(header))
+        for name, values in parse_cookies(header).iteritems():
+            self.assertEqual(values, cookie_values(header, name))
+        self.assertEqual([], cookie_values(header, 'flag'))
+        self.assertEqual([], cookie_values(header, 'colon'))
+        self.assertEqual(['2'], cookie_values('ba=1; a=2; aa=3', 'a'))
+        self.assertEqual([], cookie_values('ba=1; aa=3', 'a'))
+
+    def test_cookie_values(self):
+        req = WSGIRequest({
+            'REQUEST_METHOD':'GET',
+            'REMOTE_ADDR':'127.0.0.1',
+            'HTTP_COOKIE': 'session=abc; theme=dark; session=def',
+            'wsgi.input': StringIO.StringIO(),
+        })
+        self.assertEqual(['abc', 'def'], req.cookie_values('session'))
+        self.assertEqual([], req.cookie_values('missing'))
+        self.assertEqual(['dark'], req.cookies['theme'])
+        self.assertEqual(['dark'], req.cookie_values('theme'))
+
+    def test_route_before_parsing(self):
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='PUT', uri='/thing$',
+                     function=lambda: {'put': True}),
+            Endpoint(name='', method='POST', uri='/thing$',
+                     function=lambda a: {'a': a},
+                     args=([args.String('a')], {})),
+        ])
+        def call(path, body, query=''):
+            statuses = []
+            input = CountingInput(body)
+            result = sp({
+                'REQUEST_METHOD': 'POST',
+                'PATH_INFO': path,
+                'QUERY_STRING': query,
+                'REMOTE_ADDR': '127.0.0.1',
+                'CONTENT_TYPE': 'application/json',
+                'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': input,
+            }, lambda status, headers: statuses.append(status))
+            return statuses[0], ''.join(result).strip(), input.reads
+
+        # nothing is parsed for requests that don't reach an endpoint, or
+        # endpoints without args
+        self.assertEqual('404 Not Found', call('/missing', 'not json')[0])
+        self.assertEqual(0, call('/missing', 'not json')[2])
+        self.assertEqual(('200 OK', '{"put": true}', 0),
+                         call('/thing', 'not json', '_method=put'))
+        self.assertEqual('400 Bad Request', call('/thing', 'not json')[0])
+        self.assertEqual('{"a": "1"}', call('/thing', '{"a": "1"}')[1])
+
+    def test_write(self):
+        class Req(args.CustomArg):
+            def __init__(self):
+                self.argspec = lambda req, inargs: req
+        def chunks(req):
+            for i in xrange(3):
+                req.write('%d,' % i)
+            req.write(u'\xe9,')
+        def fails(req):
+            req.write('lost')
+            raise ValueError()
+        def returns(req):
+            req.write('lost')
+            return 'done'
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='GET', uri='/chunks$', function=chunks,
+                     args=([Req()], {}), renderer=Written('text/csv')),
+            Endpoint(name='', method='GET', uri='/fails$', function=fails,
+                     args=([Req()], {}), renderer=Written('text/csv')),
+            Endpoint(name='', method='GET', uri='/returns$', function=returns,
+                     args=([Req()], {}), renderer=Written('text/csv')),
+            # only the Written renderer may write
+            Endpoint(name='', method='GET', uri='/json$', function=chunks,
+                     args=([Req()], {})),
+            # a unicode content type fails in _finish_request
+            Endpoint(name='', method='GET', uri='/unicode$', function=chunks,
+                     args=([Req()], {}), renderer=Written(u'text/csv')),
+        ])
+        responses = []
+        def call(path):
+            return sp({
+                'REQUEST_METHOD': 'GET',
+                'PATH_INFO': path,
+                'REMOTE_ADDR': '127.0.0.1',
+                'wsgi.input': StringIO.StringIO(),
+            }, lambda status, headers: responses.append((status, headers)))
+        self.assertEqual(['0,', '1,', '2,', '\xc3\xa9,'], call('/chunks'))
+        self.assertEqual('200 OK', responses[-1][0])
+        self.assertTrue(('Content-Type', 'text/csv') in responses[-1][1])
+        for path in ('/fails', '/returns', '/json', '/unicode'):
+            body = ''.join(call(path))
+            self.assertEqual('500', responses[-1][0][:3])
+            self.assertFalse('lost' in body or '0,' in body)
+
+        req = WSGIRequest({'REQUEST_METHOD': 'GET'})
+        self.assertEqual('', req.getvalue())
+        req.write('a')
+        req.write('b')
+        self.assertEqual('ab', req.getvalue())
+
+    def test_body_stream(self):
+        input = CountingInput('[1, 2]trailing junk')
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'CONTENT_LENGTH': '6',
+            'wsgi.input': input,
+        })
+        stream = req.body_stream()
+        self.assertEqual(0, input.reads)
+        self.assertEqual('[1', stream.read(2))
+        self.assertEqual(', 2]', stream.read())
+        self.assertEqual('', stream.read(10))
+        self.assertTrue(stream is req.body_stream())
+        self.assertRaises(HTTPException, req.body_size)
+
+        req = WSGIRequest({
+            'REQUEST_METHOD':'POST',
+            'REMOTE_ADDR':'127.0.0.1',
+            'wsgi.input': CountingInput('x' * 100),
+        })
+        req.max_body_size = 10
+        stream = req.body_stream()
+        self.assertEqual('x' * 8, stream.read(8))
+        self.assertRaises(HTTPException, stream.read, 8)
+
+    def test_record_stream(self):
+        received = []
+        def ingest(records):
+            # each record is handled before the next is read
+            for record in records:
+                received.append((record, input.reads))
+            return {'count': len(received)}
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='POST', uri='/ingest$', function=ingest,
+                     args=([args.RecordStream(
+                         validator=vals.Schema({'n': vals.Int()}))], {})),
+        ])
+        def call(body, content_type='application/json'):
+            statuses = []
+            del received[:]
+            result = sp({
+                'REQUEST_METHOD': 'POST',
+                'PATH_INFO': '/ingest',
+                'REMOTE_ADDR': '127.0.0.1',
+                'CONTENT_TYPE': content_type,
+                'CONTENT_LENGTH': str(len(body)),
+                'wsgi.input': input,
+            }, lambda status, headers: statuses.append(status))
+            return statuses[0], ''.join(result).strip()
+
+        body = '[' + ', '.join(['{"n": %d, "pad": "%s"}' % (i, 'x' * 40000)
+                                for i in range(4)]) + ']'
+        input = CountingInput(body)
+        self.assertEqual(('200 OK', '{"count": 4}'), call(body))
+        self.assertEqual(range(4), [r['n'] for r, reads in received])
+        # the body was read as the records were asked for, not up front
+        self.assertTrue(received[0][1] < received[-1][1])
+
+        input = CountingInput('{"n": 1}\n{"n": 2}\n')
+        self.assertEqual('200 OK', call('{"n": 1}\n{"n": 2}\n',
+                                        'application/x-ndjson')[0])
+        self.assertEqual([1, 2], [r['n'] for r, reads in received])
+
+        input = CountingInput('n,name\r\n1,a\r\n2,b\r\n')
+        self.assertEqual('200 OK', call('n,name\r\n1,a\r\n2,b\r\n',
+                                        'text/csv; charset=utf-8')[0])
+        self.assertEqual([{'n': 1, 'name': 'a'}, {'n': 2, 'name': 'b'}],
+                         [r for r, reads in received])
+
+        input = CountingInput('[{"n": 1}, {"n": ')
+        self.assertEqual('400 Bad Request', call('[{"n": 1}, {"n": ')[0])
+        input = CountingInput('[{"n": 1}, {"m": 2}]')
+        self.assertEqual('400 Bad Request', call('[{"n": 1}, {"m": 2}]')[0])
+
+    def test_record_stream_wrong_type(self):
+        sp = ServicePublisher(endpoints=[
+            Endpoint(name='', method='POST', uri='/ingest$',
+                     function=lambda records: list(records),
+                     args=([args.RecordStream(validator=vals.Date())], {})),
+        ])
+        statuses = []
+        sp({
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': '/ingest',
+            'REMOTE_ADDR': '127.0.0.1',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': '3',
+            'wsgi.input': StringIO.StringIO('[5]'),
+        }, lambda status, headers: statuses.append(status))
+        self.assertEqual(['400 Bad Request'], statuses)